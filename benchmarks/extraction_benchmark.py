@@ -0,0 +1,168 @@
+"""
+Compares scrapers.fast_extract against newspaper's parse (as used by newspaper_parse) on
+a fixed corpus of html pages, reporting docs/sec for each and how closely the fast
+extractor's text agrees with newspaper's.
+
+Agreement is the bag of words F1 between the two texts of a page, averaged over pages
+where newspaper found any text. The share of pages where the fast extractor finds nothing
+while newspaper does (and the reverse) is reported separately.
+
+Without --corpus_directory a deterministic synthetic corpus of news style pages is
+generated - article paragraphs surrounded by navigation, link lists, sidebars, comments
+and footers. Real pages are a better test, save a few thousand into a directory as
+"*.html" files.
+
+Arguments
+---------
+--corpus_directory
+    Directory of "*.html" files to use instead of the synthetic corpus.
+--page_count (-pages)
+    Number of synthetic pages. Defaults to 2,000.
+--seed
+    Random seed for the synthetic corpus. Defaults to 0.
+"""
+
+import os
+import glob
+import random
+import argparse
+from collections import Counter
+
+import newspaper
+
+from scraping.scrapers import fast_extract
+from utils.utils import Timer
+
+import logging
+from utils.logger import setup_logger_tqdm
+logger = logging.getLogger(__name__)
+
+vocabulary = ("the of and to in a is that for it as was with be by on not he this are or "
+              "his from at which but have an they you were her she there one all we their "
+              "government market police election report city players season company study "
+              "officials minister council research energy climate court health school").split()
+
+def sentence(rng, min_words, max_words):
+    words = rng.choices(vocabulary, k=rng.randint(min_words, max_words))
+    return " ".join(words).capitalize() + "."
+
+def link_list(rng, count):
+    links = "".join(f'<li><a href="/section/{i}">{sentence(rng, 1, 3)}</a></li>'
+                    for i in range(count))
+    return f"<ul>{links}</ul>"
+
+def generate_page(rng, page_id):
+    title = sentence(rng, 4, 10)
+    paragraphs = []
+    for _ in range(rng.randint(3, 25)):
+        text = " ".join(sentence(rng, 6, 25) for _ in range(rng.randint(1, 5)))
+        if rng.random() < 0.2:
+            text += f' <a href="/related/{rng.randint(0, 999)}">{sentence(rng, 2, 5)}</a>'
+        paragraphs.append(f"<p>{text}</p>")
+
+    # Split some articles over two containers
+    if len(paragraphs) > 6 and rng.random() < 0.3:
+        split = len(paragraphs) // 2
+        article = (f'<div class="story">{"".join(paragraphs[:split])}</div>'
+                   f'<div class="story-continued">{"".join(paragraphs[split:])}</div>')
+    else:
+        article = f'<div class="story">{"".join(paragraphs)}</div>'
+
+    comments = "".join(f'<div class="comment"><p>{sentence(rng, 3, 12)}</p></div>'
+                       for _ in range(rng.randint(0, 8)))
+
+    return (f'<!DOCTYPE html><html lang="en"><head><title>{title}</title>'
+            f'<meta charset="utf-8"><script>var page = {page_id};</script>'
+            f'<style>body {{ margin: 0; }}</style></head><body>'
+            f'<header><nav>{link_list(rng, rng.randint(5, 30))}</nav></header>'
+            f'<main><article><h1>{title}</h1>{article}</article>'
+            f'<section class="comments">{comments}</section></main>'
+            f'<aside><p>{sentence(rng, 5, 15)}</p>{link_list(rng, rng.randint(3, 15))}</aside>'
+            f'<footer><p>{sentence(rng, 4, 10)}</p>{link_list(rng, 10)}</footer>'
+            f'</body></html>')
+
+def generate_corpus(page_count, seed):
+    rng = random.Random(seed)
+    return [(f"https://example{i % 50}.com/news/{i}", generate_page(rng, i))
+            for i in range(page_count)]
+
+def load_corpus(corpus_directory):
+    corpus = []
+    for html_path in sorted(glob.glob(os.path.join(corpus_directory, "*.html"))):
+        with open(html_path, "rb") as fh:
+            corpus.append((f"https://localhost/{os.path.basename(html_path)}", fh.read()))
+    return corpus
+
+def newspaper_extract(url, html):
+    article = newspaper.Article(url, fetch_images=False, memoize_articles=False)
+    article.download(input_html=html)
+    article.parse()
+    return article.title, article.meta_lang, article.text
+
+def run(corpus, extract):
+    texts = []
+    timer = Timer().start()
+    for url, html in corpus:
+        try:
+            texts.append(extract(url, html)[2])
+        except Exception:
+            texts.append("")
+    elapsed = timer.stop()
+    return texts, elapsed
+
+def word_f1(reference, candidate):
+    reference_words = Counter(reference.split())
+    candidate_words = Counter(candidate.split())
+    overlap = sum((reference_words & candidate_words).values())
+    if not overlap:
+        return 0.0
+    precision = overlap / sum(candidate_words.values())
+    recall = overlap / sum(reference_words.values())
+    return 2 * precision * recall / (precision + recall)
+
+def benchmark(corpus):
+    logger.info(f"Corpus: {len(corpus)} pages")
+
+    extractors = [
+        ("newspaper", newspaper_extract),
+        ("fast_extract", lambda url, html: fast_extract(html)),
+    ]
+
+    results = {}
+    for name, extract in extractors:
+        texts, elapsed = run(corpus, extract)
+        results[name] = texts
+        logger.info(f"  {name:>12}: {elapsed:0.2f}s, {(len(corpus) / elapsed):0.1f} docs/s")
+
+    scores = []
+    fast_only = 0
+    newspaper_only = 0
+    for newspaper_text, fast_text in zip(results["newspaper"], results["fast_extract"]):
+        if not newspaper_text.strip():
+            if fast_text.strip():
+                fast_only += 1
+            continue
+        if not fast_text.strip():
+            newspaper_only += 1
+        scores.append(word_f1(newspaper_text, fast_text))
+
+    mean_f1 = sum(scores) / len(scores) if scores else 0
+    logger.info(f"Mean word F1 against newspaper: {mean_f1:0.3f} over {len(scores)} pages")
+    logger.info(f"Text found by newspaper only: {newspaper_only}, by fast_extract only: {fast_only}")
+
+parser = argparse.ArgumentParser(description='Benchmark text extraction.')
+parser.add_argument("--corpus_directory", default=None)
+parser.add_argument("-pages", "--page_count", type=int, default=2000)
+parser.add_argument("--seed", type=int, default=0)
+
+if __name__ == '__main__':
+    setup_logger_tqdm()
+    args = parser.parse_args()
+
+    if args.corpus_directory:
+        corpus = load_corpus(args.corpus_directory)
+    else:
+        logger.info(f"Generating {args.page_count} synthetic pages...")
+        corpus = generate_corpus(args.page_count, args.seed)
+
+    benchmark(corpus)
@@ -0,0 +1,126 @@
+"""
+Compares the throughput of the original 16MB chunk/decode/split loop used by
+process_dump_file against utils.archive_stream_readers.iterate_lines, on a synthetic
+zstd compressed PushShift style dump.
+
+Both readers feed json.loads so the numbers reflect the whole read + parse path, with a
+second pass measuring line splitting alone.
+
+Arguments
+---------
+--post_count (-posts)
+    Number of synthetic posts in the generated dump. Defaults to 500,000.
+--chunk_size
+    Read size in bytes for both readers. Defaults to 16MB.
+--dump_file
+    Use an existing dump file instead of generating one.
+"""
+
+import os
+import json
+import math
+import argparse
+import tempfile
+
+import zstandard
+
+from utils.archive_stream_readers import get_archive_stream_reader, iterate_lines, default_chunk_size
+from utils.utils import Timer
+
+import logging
+from utils.logger import setup_logger_tqdm
+logger = logging.getLogger(__name__)
+
+million = math.pow(10, 6)
+
+def generate_dump(dump_file_path, post_count):
+    cctx = zstandard.ZstdCompressor(level=3)
+    with open(dump_file_path, "wb") as fh, cctx.stream_writer(fh) as compressor:
+        for i in range(post_count):
+            post = {
+                "id": format(i, "x"),
+                "is_self": i % 3 == 0,
+                "url": f"https://example{i % 5000}.com/article/{i}",
+                "score": i % 100,
+                "title": f"Synthetic post {i} with some unicode é中文",
+                "subreddit": "benchmark",
+                "created_utc": 1293840000 + i,
+                "preview": {"images": [{"source": {"url": "x" * (i % 500)}}]},
+            }
+            compressor.write(json.dumps(post).encode("utf-8") + b"\n")
+
+# The loop process_dump_file used before iterate_lines
+def legacy_lines(reader, chunk_size):
+    previous_line = ""
+    while True:
+        chunk = reader.read(chunk_size)
+        if not chunk:
+            break
+
+        try:
+            string_data = chunk.decode("utf-8")
+        except UnicodeDecodeError:
+            continue
+        lines = string_data.split("\n")
+        for i, line in enumerate(lines[:-1]):
+            if i == 0:
+                line = previous_line + line
+            yield line
+
+        previous_line = lines[-1]
+
+def run(dump_file_path, line_source, parse):
+    timer = Timer().start()
+    line_count = 0
+    with get_archive_stream_reader(dump_file_path) as reader:
+        for line in line_source(reader):
+            line_count += 1
+            if parse and line:
+                json.loads(line.decode("utf-8") if isinstance(line, bytes) else line)
+    elapsed = timer.stop()
+    return line_count, elapsed
+
+def get_uncompressed_size(dump_file_path):
+    uncompressed_size = 0
+    with get_archive_stream_reader(dump_file_path) as reader:
+        while True:
+            chunk = reader.read(default_chunk_size)
+            if not chunk:
+                break
+            uncompressed_size += len(chunk)
+    return uncompressed_size
+
+def benchmark(dump_file_path, chunk_size):
+    sources = [
+        ("legacy chunk/split", lambda reader: legacy_lines(reader, chunk_size)),
+        ("iterate_lines", lambda reader: iterate_lines(reader, chunk_size)),
+    ]
+
+    uncompressed_size = get_uncompressed_size(dump_file_path)
+    logger.info(f"Uncompressed size: {(uncompressed_size / million):0.2f} MB")
+
+    for parse in [False, True]:
+        logger.info("Split + json.loads:" if parse else "Split only:")
+        for name, line_source in sources:
+            line_count, elapsed = run(dump_file_path, line_source, parse)
+            logger.info(f"  {name:>20}: {line_count} lines, "
+                        f"{(uncompressed_size / million / elapsed):0.2f} MB/s, "
+                        f"{(line_count / elapsed):0.0f} lines/s")
+
+parser = argparse.ArgumentParser(description='Benchmark dump line reading.')
+parser.add_argument("-posts", "--post_count", type=int, default=500000)
+parser.add_argument("--chunk_size", type=int, default=default_chunk_size)
+parser.add_argument("--dump_file", default=None)
+
+if __name__ == '__main__':
+    setup_logger_tqdm()
+    args = parser.parse_args()
+
+    if args.dump_file:
+        benchmark(args.dump_file, args.chunk_size)
+    else:
+        with tempfile.TemporaryDirectory() as temp_directory:
+            dump_file_path = os.path.join(temp_directory, "RS_benchmark.zst")
+            logger.info(f"Generating {args.post_count} synthetic posts...")
+            generate_dump(dump_file_path, args.post_count)
+            benchmark(dump_file_path, args.chunk_size)
@@ -0,0 +1,290 @@
+"""
+Measures scrape_urls throughput offline. A local HTTP server (in its own process) serves
+a synthetic or recorded html corpus with configurable latency, error rate, slow drips and
+large bodies. Each engine is then run as "python -m scraping.scrape_urls" over generated
+urls_*.jsonl.zst files, and URLs/sec, p50/p99 latency, CPU time and peak RSS are reported.
+
+Urls are spread over --host_count loopback addresses (127.0.x.y), so per host limits and
+host tracking see distinct hosts. That needs the server listening on all interfaces
+rather than 127.0.0.1 only, it only runs for the length of the benchmark.
+
+Every url has a fixed profile drawn from --seed: a delay before the response of
+exponentially distributed length (mean --latency_ms), then one of
+- an error status (404 or 500), with probability --error_rate
+- a body of --large_mb, with probability --large_rate
+- a body dripped out in 1KB chunks every --drip_delay_ms, with probability --drip_rate
+- a normal page otherwise.
+Pages come from --corpus_directory ("*.html" files, served round robin) or are generated
+like benchmarks/extraction_benchmark.py.
+
+Latency percentiles are taken from the "elapsed" meta of the archived (successful)
+scrapes. CPU time covers the scrape_urls process and its pool workers. Peak RSS is that of
+the largest single process, as reported by getrusage.
+
+Arguments
+---------
+--url_count (-urls)
+    Number of urls to scrape. Defaults to 2,000.
+--urls_per_file
+    Urls per generated url file. Defaults to 1,000.
+--host_count
+    Number of distinct hosts the urls are spread over. Defaults to 200.
+--engines
+    Comma separated scrape_urls engines to run. Defaults to "pool,async".
+--scrape_args
+    Extra arguments passed to every scrape_urls run, for example "-procs 30 -timeout 10".
+--latency_ms
+    Mean response delay. Defaults to 100.
+--error_rate
+    Defaults to 0.05.
+--large_rate
+    Defaults to 0.02.
+--large_mb
+    Defaults to 8.
+--drip_rate
+    Defaults to 0.02.
+--drip_delay_ms
+    Defaults to 20.
+--corpus_directory
+    Directory of "*.html" files to serve instead of synthetic pages.
+--seed
+    Defaults to 0.
+"""
+
+import os
+import sys
+import glob
+import time
+import json
+import random
+import shlex
+import shutil
+import socket
+import argparse
+import resource
+import tempfile
+import subprocess
+import multiprocessing
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from benchmarks.extraction_benchmark import generate_page
+from utils.archiver import Archive, Reader
+
+import logging
+from utils.logger import setup_logger_tqdm
+logger = logging.getLogger(__name__)
+
+repository_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class ServerConfig:
+    def __init__(self, args):
+        self.seed = args.seed
+        self.latency = args.latency_ms / 1000
+        self.error_rate = args.error_rate
+        self.large_rate = args.large_rate
+        self.large_bytes = int(args.large_mb * 1024 * 1024)
+        self.drip_rate = args.drip_rate
+        self.drip_delay = args.drip_delay_ms / 1000
+        self.corpus = []
+        if args.corpus_directory:
+            for html_path in sorted(glob.glob(os.path.join(args.corpus_directory, "*.html"))):
+                with open(html_path, "rb") as fh:
+                    self.corpus.append(fh.read())
+
+    # Returns (delay, kind, status, body) for page page_id, always the same for a seed
+    def get_profile(self, page_id):
+        rng = random.Random(self.seed * 1000003 + page_id)
+        delay = rng.expovariate(1 / self.latency) if self.latency else 0
+
+        roll = rng.random()
+        if roll < self.error_rate:
+            return delay, "error", rng.choice([404, 500]), b"<html><body>Error</body></html>"
+
+        if self.corpus:
+            body = self.corpus[page_id % len(self.corpus)]
+        else:
+            body = generate_page(rng, page_id).encode("utf-8")
+
+        roll -= self.error_rate
+        if roll < self.large_rate:
+            padding = b"<p>" + b"padding " * 1000 + b"</p>"
+            repeats = max(self.large_bytes - len(body), 0) // len(padding) + 1
+            body = body.replace(b"</body>", padding * repeats + b"</body>")
+            return delay, "large", 200, body
+
+        roll -= self.large_rate
+        if roll < self.drip_rate:
+            return delay, "drip", 200, body
+
+        return delay, "normal", 200, body
+
+def make_handler(config):
+    class BenchmarkHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1" # Keep-alive, as real servers
+
+        def do_GET(self):
+            try:
+                page_id = int(self.path.rsplit("/", 1)[-1])
+            except ValueError:
+                page_id = 0
+
+            delay, kind, status, body = config.get_profile(page_id)
+            time.sleep(delay)
+
+            self.send_response(status)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+
+            if kind == "drip":
+                for i in range(0, len(body), 1024):
+                    self.wfile.write(body[i:i + 1024])
+                    self.wfile.flush()
+                    time.sleep(config.drip_delay)
+            else:
+                self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return BenchmarkHandler
+
+class BenchmarkServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 4096
+
+    # Scrapers hang up on responses they give up on (size cap, timeouts) at any point of
+    # the exchange, drop those quietly rather than printing a traceback for each
+    def handle_error(self, request, client_address):
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+def serve(config, port_queue):
+    server = BenchmarkServer(("0.0.0.0", 0), make_handler(config))
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+def get_host(page_id, host_count):
+    host = page_id % host_count + 1 # Skip 127.0.0.0
+    return f"127.0.{host // 256}.{host % 256}"
+
+def generate_url_files(urls_directory, url_count, urls_per_file, host_count, port):
+    os.makedirs(urls_directory, exist_ok=True)
+    for file_index, start in enumerate(range(0, url_count, urls_per_file)):
+        archiver = Archive(os.path.join(urls_directory, f"urls_{file_index}.jsonl.zst"))
+        for page_id in range(start, min(start + urls_per_file, url_count)):
+            url = f"http://{get_host(page_id, host_count)}:{port}/news/{page_id}"
+            reddit_meta = {"id": [page_id], "subreddit": ["benchmark"], "score": [10],
+                           "title": [f"Post {page_id}"], "created_utc": [1293840000]}
+            archiver.add_data(url, reddit_meta)
+        archiver.commit()
+
+    with open(os.path.join(urls_directory, "url_count.json"), "w") as fh:
+        json.dump(url_count, fh)
+
+def reset_job(job_directory):
+    shutil.rmtree(os.path.join(job_directory, "scrapes"), ignore_errors=True)
+    for path in glob.glob(os.path.join(job_directory, "urls", "*.done")):
+        os.remove(path)
+    for path in glob.glob(os.path.join(job_directory, "urls", "*.progress")):
+        os.remove(path)
+
+# Runs in a fresh process so getrusage(RUSAGE_CHILDREN) only covers this scrape
+def run_scrape(command, job_directory, result_queue):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = repository_directory + os.pathsep + env.get("PYTHONPATH", "")
+
+    output_path = os.path.join(job_directory, "scrape_output.txt")
+    start = time.perf_counter()
+    with open(output_path, "w") as output:
+        completed = subprocess.run(command, cwd=job_directory, env=env, stdout=output,
+                                   stderr=subprocess.STDOUT)
+    elapsed = time.perf_counter() - start
+
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result_queue.put((completed.returncode, elapsed, usage.ru_utime + usage.ru_stime,
+                      usage.ru_maxrss))
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+def read_scrape_latencies(job_directory):
+    latencies = []
+    for scrapes_path in glob.glob(os.path.join(job_directory, "scrapes", "*.jsonl.zst")):
+        for text, meta in Reader().read_jsonl(scrapes_path, get_meta=True):
+            if meta.get("elapsed") is not None:
+                latencies.append(meta["elapsed"])
+    return latencies
+
+def benchmark_engine(engine, job_directory, url_count, scrape_args):
+    reset_job(job_directory)
+    command = [sys.executable, "-m", "scraping.scrape_urls", "-dir", job_directory,
+               "-engine", engine] + scrape_args
+
+    result_queue = multiprocessing.Queue()
+    runner = multiprocessing.Process(target=run_scrape,
+                                     args=(command, job_directory, result_queue))
+    runner.start()
+    return_code, elapsed, cpu_time, max_rss = result_queue.get()
+    runner.join()
+
+    if return_code != 0:
+        logger.info(f"  {engine:>6}: scrape_urls exited with {return_code}, see "
+                    f"{os.path.join(job_directory, 'scrape_output.txt')}")
+        return
+
+    latencies = read_scrape_latencies(job_directory)
+    success_percentage = len(latencies) / url_count * 100
+    logger.info(f"  {engine:>6}: {(url_count / elapsed):0.1f} URLs/s, "
+                f"{success_percentage:0.1f}% archived, "
+                f"p50 {percentile(latencies, 0.5):0.2f}s, p99 {percentile(latencies, 0.99):0.2f}s, "
+                f"CPU {cpu_time:0.1f}s, peak RSS {(max_rss / 1024):0.0f} MB")
+
+def benchmark(args, job_directory):
+    config = ServerConfig(args)
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, args=(config, port_queue), daemon=True)
+    server.start()
+    port = port_queue.get()
+
+    try:
+        # Server is listening once the port is known, check a secondary host is reachable
+        socket.create_connection((get_host(1, args.host_count), port), timeout=5).close()
+
+        logger.info(f"Generating {args.url_count} urls over {args.host_count} hosts...")
+        generate_url_files(os.path.join(job_directory, "urls"), args.url_count,
+                           args.urls_per_file, args.host_count, port)
+
+        scrape_args = shlex.split(args.scrape_args)
+        logger.info(f"Scraping, extra scrape_urls arguments: {scrape_args}")
+        for engine in args.engines.split(","):
+            benchmark_engine(engine.strip(), job_directory, args.url_count, scrape_args)
+    finally:
+        server.terminate()
+        server.join()
+
+parser = argparse.ArgumentParser(description='Benchmark scrape_urls against a local server.')
+parser.add_argument("-urls", "--url_count", type=int, default=2000)
+parser.add_argument("--urls_per_file", type=int, default=1000)
+parser.add_argument("--host_count", type=int, default=200)
+parser.add_argument("--engines", default="pool,async")
+parser.add_argument("--scrape_args", default="")
+parser.add_argument("--latency_ms", type=float, default=100)
+parser.add_argument("--error_rate", type=float, default=0.05)
+parser.add_argument("--large_rate", type=float, default=0.02)
+parser.add_argument("--large_mb", type=float, default=8)
+parser.add_argument("--drip_rate", type=float, default=0.02)
+parser.add_argument("--drip_delay_ms", type=float, default=20)
+parser.add_argument("--corpus_directory", default=None)
+parser.add_argument("--seed", type=int, default=0)
+
+if __name__ == '__main__':
+    setup_logger_tqdm()
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as job_directory:
+        benchmark(args, job_directory)
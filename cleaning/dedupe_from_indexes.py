@@ -13,6 +13,9 @@ Arguments
     Directory containing the "*duplicates.txt" files along with the "file_name_lookup.pkl"
     created during batch slicing. The "_final.jsonl.zst" files will be output in their
     original directories.
+--zstd_threads
+    Threads used to decompress the ".minscored" files, which filter_from_reddit_scores.py
+    writes in multiple frames so they can be decompressed in parallel. Defaults to 0.
 """
 
 import glob
@@ -28,7 +31,7 @@ import logging
 from utils.logger import setup_logger_tqdm
 logger = logging.getLogger(__name__)
 
-def main(batch_directory):
+def main(batch_directory, zstd_threads=0):
     file_name_lookup_path = os.path.join(batch_directory, "file_name_lookup.pkl")
     file_name_lookup = pickle.load(open(file_name_lookup_path,"rb"))
 
@@ -47,21 +50,22 @@ def main(batch_directory):
         final_file_name = original_file_name.replace("_default.jsonl.zst.deduped.merged.minscored",
                                                      "_final.jsonl.zst")
 
-        reader = Reader()
+        reader = Reader(threads=zstd_threads)
         count = 0
         archiver = Archive(final_file_name)
-        for document, metadata in reader.read_jsonl(original_file_name, get_meta=True):
+        for line in reader.read_jsonl_lines(original_file_name):
             if count not in duplicates_dict[file_id]:
-                archiver.add_data(document, metadata)
+                archiver.add_raw(line)
             count += 1
         archiver.commit()
 
 parser = argparse.ArgumentParser(description='Dedupe from provided indexes.')
 parser.add_argument("-dir", "--batch_directory", default="")
+parser.add_argument("--zstd_threads", type=int, default=0)
 
 if __name__ == '__main__':
     logfile_path = "dedupe_from_index.log"
     setup_logger_tqdm(logfile_path)
 
     args = parser.parse_args()
-    main(args.batch_directory)
\ No newline at end of file
+    main(args.batch_directory, args.zstd_threads)
\ No newline at end of file
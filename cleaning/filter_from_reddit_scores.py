@@ -12,6 +12,11 @@ Arguments
 --scrape_directory (-dir)
     Directory containing the scrapes. You could use the overall work directory if you 
     want as we use glob.glob to search recursively.
+--zstd_threads
+    Threads used by each process to decompress a scrape file. The scrapes are written in
+    many frames (one per checkpoint), which are decompressed in parallel. The filtered
+    files are written in frames of output_frame_size for dedupe_from_indexes.py to do the
+    same. Defaults to 0.
 """
 
 import argparse
@@ -32,23 +37,24 @@ from utils.logger import setup_logger_tqdm
 logger = logging.getLogger(__name__)
 
 million = math.pow(10, 6)
+output_frame_size = 16 * 1024 * 1024
 
 # Multiprocessed
-def process_file(file_path, tqdm_func, global_tqdm):
-    reader = Reader()
+def process_file(file_path, zstd_threads, tqdm_func, global_tqdm):
+    reader = Reader(threads=zstd_threads)
 
     filtered_archive_path = file_path + ".minscored"
-    archiver = Archive(filtered_archive_path)
+    archiver = Archive(filtered_archive_path, frame_size=output_frame_size)
 
-    for document, metadata in reader.read_jsonl(file_path, get_meta=True):
-        total_score = reduce(add, metadata["reddit_scores"])
+    for line, record in reader.read_jsonl_raw(file_path):
+        total_score = reduce(add, record["meta"]["reddit_scores"])
         if total_score >= 3:
-            archiver.add_data(document, metadata)
+            archiver.add_raw(line)
 
     global_tqdm.update(os.path.getsize(file_path))
     archiver.commit()
 
-def filter_from_reddit_scores(scrape_directory):
+def filter_from_reddit_scores(scrape_directory, zstd_threads=0):
     files = glob.glob(os.path.join(scrape_directory, "**/scrapes_*.jsonl.zst"), recursive=True)
     total_file_size = reduce(add, map(os.path.getsize, files))
     logger.info(f"Total File Size: {(total_file_size / million):.2f} MB")
@@ -59,7 +65,7 @@ def filter_from_reddit_scores(scrape_directory):
         process_count = 4
         tasks = []
         for file_path in files:
-            task = (process_file, (file_path,))
+            task = (process_file, (file_path, zstd_threads))
             tasks.append(task)
 
         on_done = lambda _ : None
@@ -71,6 +77,7 @@ def filter_from_reddit_scores(scrape_directory):
 parser_description = 'Filter scrapes based on minimum reddit scores.'
 parser = argparse.ArgumentParser(description=parser_description)
 parser.add_argument("-dir", "--scrape_directory", default="")
+parser.add_argument("--zstd_threads", type=int, default=0)
 
 if __name__ == '__main__':
     args = parser.parse_args()
@@ -82,5 +89,5 @@ if __name__ == '__main__':
     setup_logger_tqdm(log_file)
     
     logger.info("Filtering scrapes based on minimum reddit scores.")
-    filter_from_reddit_scores(args.scrape_directory)  
+    filter_from_reddit_scores(args.scrape_directory, args.zstd_threads)  
     
@@ -9,10 +9,13 @@ get_url_content_length(url)
     a get request on the provided 'url'. Returns the number of bytes
     if available, or None.
 
-build_file_list(start_date, end_date):
+build_file_list(start_date, end_date, manifest_path=None, base_url=default_base_url, probe_threads=16):
     Builds a list of PushShift submission dump files located at 
     "https://files.pushshift.io/reddit/submissions" within the desired date
-    range.
+    range. HEAD requests to find the archive format of each month are made
+    concurrently on a pooled session. If 'manifest_path' is given, found months 
+    are cached there as json so re-runs and resumes skip probing entirely. The
+    manifest records the base_url it was built from and is ignored for any other.
 
 get_sha256sums
     Downloads the sha256sum file for the PushShift submission dumps from
@@ -22,17 +25,22 @@ get_sha256sums
 
 from dateutil.relativedelta import *
 import math
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
+from requests.adapters import HTTPAdapter
 
 import logging
 logger = logging.getLogger(__name__)
 
 million = math.pow(10, 6)
 possible_archive_formats = ["zst", "xz", "bz2"]
+default_base_url = "https://files.pushshift.io/reddit/submissions"
 
-def get_url_content_length(url):
-    response = requests.head(url)
+def get_url_content_length(url, session=requests):
+    response = session.head(url)
     response.raise_for_status()
 
     if "Content-Length" in response.headers:
@@ -40,38 +48,80 @@ def get_url_content_length(url):
     else:
         return None
 
-def build_file_list(start_date, end_date):
-    base_url = "https://files.pushshift.io/reddit/submissions"
-    url_list = []
+def get_probe_session(probe_threads):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=probe_threads)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def probe_month(session, base_url, year, month):
+    if year < "2011":
+        return f"{base_url}/RS_v2_{year}-{month}.xz"
+
+    for extension in possible_archive_formats:
+        url = f"{base_url}/RS_{year}-{month}.{extension}"
+        try:
+            get_url_content_length(url, session) # If this fails there's no file
+            return url
+        except:
+            pass
+
+    return None
+
+# {"base_url": base_url, "months": {"YYYY-MM": url}}, only found months are stored so
+# missing months get probed again. Returns the months, empty if base_url has changed.
+def load_manifest(manifest_path, base_url):
+    if not manifest_path or not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path, "r") as fh:
+        manifest = json.load(fh)
+
+    if manifest.get("base_url") != base_url:
+        logger.info("Manifest was built from a different base url, ignoring it.")
+        return {}
+    return manifest["months"]
+
+def save_manifest(months, manifest_path, base_url):
+    if manifest_path:
+        with open(manifest_path, "w") as fh:
+            json.dump({"base_url": base_url, "months": months}, fh, indent=1, sort_keys=True)
+
+def build_file_list(start_date, end_date, manifest_path=None, base_url=default_base_url,
+                    probe_threads=16):
+    manifest = load_manifest(manifest_path, base_url)
+
+    months = []
     date = start_date
-    current_year = None
     while date <= end_date:
-        year = date.strftime("%Y")
-        month = date.strftime("%m")
+        months.append((date.strftime("%Y"), date.strftime("%m")))
+        date = date + relativedelta(months=+1)
 
-        if year != current_year:
-            current_year = year
-            logger.info(f"Scanning Year {current_year}")
+    to_probe = [(year, month) for year, month in months if f"{year}-{month}" not in manifest]
+    if to_probe:
+        logger.info(f"Probing {len(to_probe)} months, {len(months) - len(to_probe)} found in manifest.")
+        session = get_probe_session(probe_threads)
+        with ThreadPoolExecutor(probe_threads) as executor:
+            futures = [executor.submit(probe_month, session, base_url, year, month)
+                       for year, month in to_probe]
+            for (year, month), future in zip(to_probe, futures):
+                url = future.result()
+                if url:
+                    manifest[f"{year}-{month}"] = url
+        session.close()
+        save_manifest(manifest, manifest_path, base_url)
 
-        if year < "2011":
-            url = f"{base_url}/RS_v2_{year}-{month}.xz"
+    url_list = []
+    for year, month in months:
+        url = manifest.get(f"{year}-{month}")
+        if url:
             url_list.append(url)
-        else:
-            for extension in possible_archive_formats:
-                url = f"{base_url}/RS_{year}-{month}.{extension}"
-                try:
-                    get_url_content_length(url) # If this fails there's no file
-                    url_list.append(url)
-                    break
-                except:
-                    pass
-
-        date = date + relativedelta(months=+1)
 
     return url_list
 
 def get_sha256sums():
-    sha256sum_url = "https://files.pushshift.io/reddit/submissions/sha256sums.txt"
+    sha256sum_url = f"{default_base_url}/sha256sums.txt"
 
     sha256sum_lookup = {}
     with requests.get(sha256sum_url) as response:
@@ -4,8 +4,10 @@ for a given period, defaulting to 1,000,000 urls per file. Using lm_dataformat,
 one record is stored for each URL, along with the metadata of all submissions for 
 that particular URL. 
 
-No separate URL based deduplication is required unless you run multiple iterations of
-the script across different time periods (unimplemented but very simple).
+URLs are grouped by exact string. With --url_index each URL is also canonicalized
+(scheme, "www.", tracking parameters etc. dropped, see utils/url_index.py) and claimed in
+a persistent index, so other spellings of a page, and pages already written by a run for
+an earlier period, are skipped. Only the first spelling's submissions are kept.
 
 Note that we don't filter by score at this stage as the full pipeline scrapes all urls
 and leaves the filtering to be done by the user if they don't want the plug and play version.
@@ -23,70 +25,223 @@ Arguments
 --min_score
     Minimum aggregate submissions score to include url.
 --data_source
-    Where to find sorted URLs: "db" or "tsv". tsv doesn't support date ranges.
+    Where to find sorted URLs: "db" or "tsv". tsv reads the sorted shards written by
+    pushshift_to_tsv.py, skipping sqlite entirely.
+--tsv_directory
+    Directory containing the "*.tsv.zst" shards. Defaults to the tsv subdirectory of
+    output_directory.
+--grouping (-group)
+    How db rows are sorted by url: "sql" (ORDER BY url in sqlite), "external" (external
+    merge sort) or "hash" (hash partitioned buckets sorted in parallel). See url_grouping.py.
+    Defaults to "sql".
+--rows_per_run
+    Rows sorted in memory per run for "external" grouping. Defaults to 1,000,000.
+--partitions
+    Number of buckets for "hash" grouping. Defaults to 64.
+--process_count (-procs)
+    Processes sorting buckets for "hash" grouping. Defaults to 4.
+--writer_processes (-writers)
+    Processes compressing and writing completed url files while the next one is being
+    grouped. 0 writes them in the main process. Defaults to 2.
+--compression_level
+    zstd compression level for the url files. Defaults to 3.
+--url_index
+    sqlite file holding canonical URLs already written, shared by runs for different
+    periods. Defaults to None (no cross-spelling or cross-run dedupe).
 
 If both start_period and finish_period are blank then we can use a faster query on the reddit_submission
-table.
+table. With a date range "sql" grouping makes sqlite sort the whole range in a temporary B-tree,
+the other grouping modes avoid this and are much faster. All three produce identical files.
 """
 
 import datetime
 from dateutil.relativedelta import *
 import argparse
 import os
+import glob
 import json
+import multiprocessing
+from array import array
+from collections import deque
 from functools import partial
 import sys
 
 from utils.archiver import Archive
+from utils.url_index import UrlIndex
 from .models import RedditSubmission, get_db_session
+from .url_grouping import external_sort, hash_partition_sort
+from .tsv_shards import read_sorted_shards
 
 import logging
 from utils.logger import setup_logger_tqdm
 logger = logging.getLogger(__name__)
 
-def get_from_db(start_date, end_date):
+def get_from_db(start_date, end_date, ordered=True):
     db_session = get_db_session()
 
     # SELECT id, url, score, title, subreddit, created_utc
     # FROM reddit_submission
     # WHERE created_utc >= start_date and created_utc <= end_date
-    # ORDER BY url
+    # ORDER BY url, id
     select_fields = (RedditSubmission.id, RedditSubmission.url, RedditSubmission.score,
                      RedditSubmission.title, RedditSubmission.subreddit, RedditSubmission.created_utc)
 
+    query = db_session.query(*select_fields)
     if start_date or end_date:
         month_end = end_date + relativedelta(months=+1)
-        query = db_session.query(*select_fields) \
-                          .filter(RedditSubmission.created_utc >= start_date) \
-                          .filter(RedditSubmission.created_utc < month_end) \
-                          .order_by(RedditSubmission.url) \
-                          .yield_per(1000)
-    else:
-        query = db_session.query(*select_fields) \
-                          .order_by(RedditSubmission.url) \
-                          .yield_per(1000)
+        query = query.filter(RedditSubmission.created_utc >= start_date) \
+                     .filter(RedditSubmission.created_utc < month_end)
+
+    if ordered:
+        query = query.order_by(RedditSubmission.url, RedditSubmission.id)
+
+    query = query.yield_per(1000)
 
     logger.info("Querying sqlite database for submissions")
     logger.info(query)
     return query
 
-def get_from_tsv():
-    pass
+def get_grouped_from_db(start_date, end_date, grouping, temp_directory, rows_per_run,
+                        partitions, process_count):
+    rows = (tuple(row) for row in get_from_db(start_date, end_date, ordered=False))
+    if grouping == "external":
+        return external_sort(rows, temp_directory, rows_per_run)
+    elif grouping == "hash":
+        return hash_partition_sort(rows, temp_directory, partitions, process_count)
+    raise ValueError(f"Invalid grouping {grouping}")
 
+def get_from_tsv(tsv_directory, start_date, end_date):
+    shard_paths = sorted(glob.glob(os.path.join(tsv_directory, "*.tsv.zst")))
 
-def generate_urls(url_directory, urls_per_file, min_score, source):
+    month_end = None
+    if end_date:
+        month_end = end_date + relativedelta(months=+1)
 
-    url_batch = 0
-    url_file_path = os.path.join(url_directory, f"urls_{url_batch}.jsonl.zst")
-    archiver = Archive(url_file_path)
+    logger.info(f"Reading tsv shards from '{tsv_directory}'")
+    return read_sorted_shards(shard_paths, start_date, month_end)
+
+
+# Runs in the writer processes
+def write_url_file(url_file_path, records, compression_level):
+    archiver = Archive(url_file_path, compression_level)
+    for url, meta in records:
+        archiver.add_data(url, meta)
+    archiver.commit()
+    return len(records)
+
+# Completed url files are handed to a pool so json encoding and compression overlap with
+# grouping the next file. Up to writer_processes + 1 files are in flight, so with the
+# one being grouped at most writer_processes + 2 files are held in memory.
+class UrlFileWriter:
+    def __init__(self, url_directory, compression_level=3, writer_processes=0):
+        self.url_directory = url_directory
+        self.compression_level = compression_level
+        self.max_in_flight = writer_processes + 1
+        self.in_flight = deque()
+        self.url_batch = 0
+        self.pool = multiprocessing.Pool(writer_processes) if writer_processes > 0 else None
+        os.makedirs(url_directory, exist_ok=True)
+
+    def write(self, records):
+        url_file_path = os.path.join(self.url_directory, f"urls_{self.url_batch}.jsonl.zst")
+        self.url_batch += 1
+
+        if not self.pool:
+            write_url_file(url_file_path, records, self.compression_level)
+            return
+
+        while len(self.in_flight) >= self.max_in_flight:
+            self.in_flight.popleft().get()
+
+        args = (url_file_path, records, self.compression_level)
+        self.in_flight.append(self.pool.apply_async(write_url_file, args))
+
+    def close(self):
+        if not self.pool:
+            return
+
+        try:
+            while self.in_flight:
+                self.in_flight.popleft().get()
+        finally:
+            self.pool.terminate()
+
+def generate_urls(url_directory, urls_per_file, min_score, source, compression_level=3,
+                  writer_processes=0, url_index_path=None):
+
+    url_index = None
+    if url_index_path:
+        url_index = UrlIndex(url_index_path, "generated", os.path.abspath(url_directory))
+
+    writer = UrlFileWriter(url_directory, compression_level, writer_processes)
+    try:
+        total_url_count = write_url_files(writer, urls_per_file, min_score, source, url_index)
+    finally:
+        writer.close()
+        if url_index:
+            url_index.close()
+
+    if url_index:
+        logger.info(f"Skipped {url_index.duplicate_count} URLs already in the url index")
+
+    url_count_path = os.path.join(url_directory, "url_count.json")
+    json.dump(total_url_count, open(url_count_path, "w"))
+
+# Submissions for the current url. The same arrays are reused for every url and only grow
+# when a url has more submissions than any before it, so heavily reposted urls don't churn
+# through millions of small lists. The meta dict is only built for urls we keep.
+class UrlAccumulator:
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        self.ids = array("q", bytes(8 * capacity))
+        self.scores = array("q", bytes(8 * capacity))
+        self.titles = [None] * capacity
+        self.subreddits = [None] * capacity
+        self.created_utcs = [None] * capacity
+        self.count = 0
+        self.total_score = 0
+
+    def reset(self):
+        self.count = 0
+        self.total_score = 0
+
+    def grow(self):
+        self.ids.extend(array("q", bytes(8 * self.capacity)))
+        self.scores.extend(array("q", bytes(8 * self.capacity)))
+        self.titles.extend([None] * self.capacity)
+        self.subreddits.extend([None] * self.capacity)
+        self.created_utcs.extend([None] * self.capacity)
+        self.capacity *= 2
+
+    def add(self, submission_id, score, title, subreddit, created_utc):
+        if self.count == self.capacity:
+            self.grow()
+
+        i = self.count
+        self.ids[i] = submission_id
+        self.scores[i] = score
+        self.titles[i] = title
+        self.subreddits[i] = subreddit
+        self.created_utcs[i] = created_utc
+        self.count += 1
+        self.total_score += score
+
+    def get_meta(self):
+        count = self.count
+        meta = {}
+        meta["id"] = self.ids[:count].tolist()
+        meta["score"] = self.scores[:count].tolist()
+        meta["title"] = self.titles[:count]
+        meta["subreddit"] = self.subreddits[:count]
+        meta["created_utc"] = self.created_utcs[:count]
+        return meta
+
+def write_url_files(writer, urls_per_file, min_score, source, url_index=None):
+    claim = url_index.claim if url_index else (lambda url: True)
+    records = []
 
     current_url = ""
-    current_meta = {}
-    current_meta["id"] = []
-    current_meta["score"] = []
-    current_meta["title"] = []
-    current_meta["subreddit"] = []
-    current_meta["created_utc"] = []
+    accumulator = UrlAccumulator()
 
     total_url_count = 0
     url_count = 0
@@ -96,41 +251,29 @@ def generate_urls(url_directory, urls_per_file, min_score, source):
             current_url = url
         elif url != current_url:
             # New URL - Add Old URL and meta to archive if score is high enough
-            total_score = sum(current_meta["score"])
-            if (total_score >= min_score):
-                archiver.add_data(current_url, current_meta)
+            if accumulator.total_score >= min_score and claim(current_url):
+                records.append((current_url, accumulator.get_meta()))
                 url_count += 1
                 total_url_count += 1
 
-                # Commit and Init New Archive if full
+                # Hand over the file if full
                 if url_count == urls_per_file:
-                    archiver.commit()
-                    url_batch += 1
-                    url_file_path = os.path.join(url_directory, f"urls_{url_batch}.jsonl.zst")
-                    archiver = Archive(url_file_path)
+                    writer.write(records)
+                    records = []
                     url_count = 0
 
             current_url = url
-            current_meta = {}
-            current_meta["id"] = []
-            current_meta["score"] = []
-            current_meta["title"] = []
-            current_meta["subreddit"] = []
-            current_meta["created_utc"] = []
-
-        current_meta["id"].append(submission_id)
-        current_meta["score"].append(score)
-        current_meta["title"].append(title)
-        current_meta["subreddit"].append(subreddit)
-        current_meta["created_utc"].append(created_utc)
+            accumulator.reset()
+
+        accumulator.add(submission_id, score, title, subreddit, created_utc)
 
     if url_count > 0:
-        archiver.add_data(current_url, current_meta)
-        total_url_count += 1        
-        archiver.commit()
+        if claim(current_url):
+            records.append((current_url, accumulator.get_meta()))
+            total_url_count += 1
+        writer.write(records)
 
-    url_count_path = os.path.join(url_directory, "url_count.json")
-    json.dump(total_url_count, open(url_count_path, "w"))
+    return total_url_count
 
 parser_description = 'Generate URL files from sqlite database containing URLs and reddit metadata.'
 parser = argparse.ArgumentParser(description=parser_description)
@@ -140,6 +283,14 @@ parser.add_argument("-dir", "--output_directory", default="")
 parser.add_argument("--urls_per_file", type=int, default=100000)
 parser.add_argument("-score", "--min_score", type=int, default=3)
 parser.add_argument("-source", "--data_source", default="db")
+parser.add_argument("--tsv_directory", default=None)
+parser.add_argument("-group", "--grouping", default="sql", choices=["sql", "external", "hash"])
+parser.add_argument("--rows_per_run", type=int, default=1000000)
+parser.add_argument("--partitions", type=int, default=64)
+parser.add_argument("-procs", "--process_count", type=int, default=4)
+parser.add_argument("-writers", "--writer_processes", type=int, default=2)
+parser.add_argument("--compression_level", type=int, default=3)
+parser.add_argument("--url_index", default=None)
 
 if __name__ == '__main__':
     args = parser.parse_args()
@@ -174,15 +325,23 @@ if __name__ == '__main__':
     logger.info(f"Minimum score: {args.min_score}")
     logger.info(f"URLs per file: {args.urls_per_file}")
 
-    if args.data_source == "db":
+    if args.data_source == "db" and args.grouping == "sql":
         source = partial(get_from_db, start_date, end_date)
+    elif args.data_source == "db":
+        temp_directory = os.path.join(args.output_directory, "url_grouping_temp")
+        source = partial(get_grouped_from_db, start_date, end_date, args.grouping, temp_directory,
+                         args.rows_per_run, args.partitions, args.process_count)
     elif args.data_source == "tsv":
-        source = get_from_tsv
+        tsv_directory = args.tsv_directory or os.path.join(args.output_directory, "tsv")
+        source = partial(get_from_tsv, tsv_directory, start_date, end_date)
     else:
         logger.info(f"Invalid source {args.data_source}")
         sys.exit(-1)
 
     logger.info(f"Data source: {args.data_source}")    
+    if args.data_source == "db":
+        logger.info(f"Grouping: {args.grouping}")
 
-    generate_urls(urls_directory, args.urls_per_file, args.min_score, source)
+    generate_urls(urls_directory, args.urls_per_file, args.min_score, source,
+                  args.compression_level, args.writer_processes, args.url_index)
 
@@ -8,10 +8,13 @@ import configparser
 
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy import Column, Integer, Text, DateTime
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, insert, text
 from sqlalchemy.schema import Index
 from sqlalchemy.orm import sessionmaker
 
+import logging
+logger = logging.getLogger(__name__)
+
 base = declarative_base()
 
 class RedditSubmission(base):
@@ -24,11 +27,26 @@ class RedditSubmission(base):
     created_utc = Column(DateTime, index=True)
 
 # Index('idx_url_created', RedditSubmission.url, RedditSubmission.created_utc)
-    
-def get_db_session():
+
+# Column order for the plain tuples used by the bulk insert path
+submission_columns = ("id", "url", "score", "title", "subreddit", "created_utc")
+
+# Durability is traded for speed during bulk load, a crash means re-running the
+# month anyway as the .dbdone file won't exist yet.
+bulk_load_pragmas = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=OFF",
+    "PRAGMA cache_size=-1000000", # Negative is KiB, so ~1GB
+    "PRAGMA temp_store=MEMORY",
+]
+
+def get_db_url():
     config = configparser.ConfigParser()
     config.read('alembic.ini')
-    db_url = config["alembic"]["sqlalchemy.url"]    
+    return config["alembic"]["sqlalchemy.url"]
+
+def get_db_session():
+    db_url = get_db_url()
 
     fresh_db = False
     db_file_path = db_url.replace("sqlite:///","")
@@ -38,17 +56,85 @@ def get_db_session():
     engine = create_engine(db_url)
     if fresh_db:
         base.metadata.create_all(engine)
- 
+
     Session = sessionmaker(bind=engine)
     db_session = Session()
     return db_session
 
+def get_bulk_load_engine():
+    db_url = get_db_url()
+
+    engine = create_engine(db_url)
+
+    @event.listens_for(engine, "connect")
+    def set_bulk_load_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in bulk_load_pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    base.metadata.create_all(engine)
+    return engine
+
+class BulkSubmissionWriter:
+    """
+    Writes batches of plain submission tuples (see submission_columns) with a single
+    executemany of INSERT OR IGNORE, so duplicate ids are skipped row by row instead of
+    rolling back the whole batch.
+    """
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.connection = engine.raw_connection()
+
+        table = RedditSubmission.__table__
+        statement = insert(table).prefix_with("OR IGNORE")
+        self.sql = str(statement.compile(dialect=engine.dialect))
+
+        # Store datetimes exactly as the ORM would so created_utc range queries still match
+        created_utc_type = table.c.created_utc.type.dialect_impl(engine.dialect)
+        self.created_utc_processor = created_utc_type.bind_processor(engine.dialect)
+
+    def write(self, rows):
+        created_utc_index = submission_columns.index("created_utc")
+        processor = self.created_utc_processor
+        if processor:
+            rows = [row[:created_utc_index] + (processor(row[created_utc_index]),)
+                    + row[created_utc_index + 1:] for row in rows]
+
+        cursor = self.connection.cursor()
+        cursor.executemany(self.sql, rows)
+        inserted = cursor.rowcount
+        cursor.close()
+        self.connection.commit()
+        return inserted
+
+    def close(self):
+        self.connection.close()
+
+# Deferred index build. Loading into a table without the secondary indexes avoids
+# random B-tree writes for every row, building them once at the end is a single sort.
+composite_index_sql = "CREATE INDEX IF NOT EXISTS idx_url_created ON reddit_submission (url, created_utc)"
+
+def drop_secondary_indexes(engine):
+    base.metadata.create_all(engine)
+    for index in RedditSubmission.__table__.indexes:
+        index.drop(engine, checkfirst=True)
+
+def build_secondary_indexes(engine, composite=False):
+    for index in RedditSubmission.__table__.indexes:
+        logger.info(f"Building index {index.name}")
+        index.create(engine, checkfirst=True)
+
+    if composite:
+        logger.info("Building index idx_url_created")
+        with engine.begin() as connection:
+            connection.execute(text(composite_index_sql))
+
 def recreate_db():
-    config = configparser.ConfigParser()
-    config.read('alembic.ini')
-    db_url = config["alembic"]["sqlalchemy.url"]
+    db_url = get_db_url()
 
-    db_file_path = db_url.replace("sqlite:///","")    
+    db_file_path = db_url.replace("sqlite:///","")
     if os.path.exists(db_file_path):
         os.remove(db_file_path) # sqlite doesn't truncate on drop_all
 
@@ -56,4 +142,4 @@ def recreate_db():
     base.metadata.create_all(engine)
 
 if __name__ == '__main__':
-    recreate_db()
\ No newline at end of file
+    recreate_db()
@@ -0,0 +1,102 @@
+"""
+Called from pushshift_to_sqlite.py when --prefetch is specified.
+
+DumpPrefetcher downloads the next K dumps in a background process while the current one
+is being processed in the main process, so the network and CPU are busy at the same time.
+Downloads still run one after another and each is verified against the sha256 sums, only
+dumps that downloaded and verified successfully are handed over for processing.
+
+Before scheduling another download we check the dump size with a HEAD request against the
+free space on the dumps drive, less any downloads already in flight and a reserve. If it
+doesn't fit we wait for the current dump to be processed (and deleted if --keep_dumps isn't
+set) before trying again. When nothing else is on disk the next dump is always downloaded
+so we can't deadlock on a full drive.
+"""
+
+import os
+import math
+import shutil
+import multiprocessing
+from collections import deque
+
+from best_download import download_file
+
+from .download_pushshift_dumps import get_url_content_length
+
+import logging
+logger = logging.getLogger(__name__)
+
+million = math.pow(10, 6)
+
+# Runs in the download process
+def download_dump(url, dump_file_path, sha256sum):
+    try:
+        download_file(url, dump_file_path, sha256sum)
+    except Exception as ex:
+        logger.info(f"Download failed {ex}, skipping processing.")
+        return False
+
+    return True
+
+class DumpPrefetcher:
+    def __init__(self, url_list, sha256sums, dumps_directory, prefetch_count,
+                 reserved_disk_space=0):
+        self.url_list = url_list
+        self.sha256sums = sha256sums
+        self.dumps_directory = dumps_directory
+        self.prefetch_count = prefetch_count
+        self.reserved_disk_space = reserved_disk_space
+        self.dump_sizes = {}
+
+    def get_dump_file_path(self, url):
+        base_name = url.split('/')[-1]
+        return os.path.join(self.dumps_directory, base_name)
+
+    def get_dump_size(self, url):
+        if url not in self.dump_sizes:
+            try:
+                self.dump_sizes[url] = get_url_content_length(url) or 0
+            except Exception as ex:
+                logger.info(f"Couldn't get size of '{url}': {ex}")
+                self.dump_sizes[url] = 0
+
+        return self.dump_sizes[url]
+
+    def has_disk_space(self, dump_size, in_flight):
+        outstanding = sum(size for _, _, async_result, size in in_flight
+                          if not async_result.ready())
+        free_space = shutil.disk_usage(self.dumps_directory).free - outstanding
+        return free_space >= dump_size + self.reserved_disk_space
+
+    def schedule(self, pool, pending_urls, in_flight, limit, ignore_disk_space=False):
+        while pending_urls and len(in_flight) < limit:
+            url = pending_urls[0]
+            dump_size = self.get_dump_size(url)
+            if not ignore_disk_space and not self.has_disk_space(dump_size, in_flight):
+                logger.info(f"Not enough free space to prefetch '{url}' "
+                            f"({(dump_size / million):.2f} MB), waiting.")
+                break
+
+            pending_urls.popleft()
+            dump_file_path = self.get_dump_file_path(url)
+            sha256sum = self.sha256sums.get(os.path.basename(dump_file_path))
+            async_result = pool.apply_async(download_dump, (url, dump_file_path, sha256sum))
+            in_flight.append((url, dump_file_path, async_result, dump_size))
+
+    # Yields (url, dump_file_path, downloaded) in url_list order
+    def __iter__(self):
+        pending_urls = deque(self.url_list)
+        in_flight = deque()
+
+        with multiprocessing.Pool(1) as pool:
+            while pending_urls or in_flight:
+                # Nothing else on disk, the next dump has to be downloaded regardless
+                if not in_flight:
+                    self.schedule(pool, pending_urls, in_flight, 1, ignore_disk_space=True)
+
+                url, dump_file_path, async_result, _ = in_flight.popleft()
+                downloaded = async_result.get()
+
+                # Prefetch while this dump is being processed
+                self.schedule(pool, pending_urls, in_flight, self.prefetch_count)
+                yield url, dump_file_path, downloaded
@@ -0,0 +1,185 @@
+"""
+Called from pushshift_to_sqlite.py when --parse_workers is specified.
+
+Sqlite only allows a single writer, so rather than each worker inserting directly we
+split the work into a producer/consumer pipeline:
+
+1. A pool of worker processes, each downloading, decompressing and parsing a different
+   dump file. process_reddit_post_row turns each post into a plain tuple, which are
+   batched and put onto a bounded queue.
+2. A single dedicated writer process draining the queue into sqlite with
+   models.BulkSubmissionWriter (INSERT OR IGNORE + bulk load pragmas).
+
+Each worker puts a (dump_file_path, None) marker on the queue after its final batch. As
+the queue is FIFO the writer has committed every row from that dump by the time it sees
+the marker, at which point it creates the .dbdone file, so resume works exactly as in
+the sequential path.
+
+The queue is bounded so fast parsers block instead of buffering an entire dump in memory
+when the writer falls behind. Puts time out every writer_poll_interval seconds to check the
+writer is still running, if it died the parsers give up on their dumps (left without a
+.dbdone, for the next run) rather than waiting forever, and its exit code is raised as a
+WriterStoppedError once the pool is done.
+"""
+
+import os
+import queue
+import threading
+import multiprocessing
+from collections import Counter
+
+from best_download import download_file
+from tqdm_multiprocess import TqdmMultiProcessPool
+
+from .process_dump_files_sqlite import read_dump_posts, process_reddit_post_row, log_parse_counters
+from .models import get_bulk_load_engine, BulkSubmissionWriter
+from utils.logger import setup_logger_child_process
+from utils.utils import Timer
+
+import logging
+logger = logging.getLogger(__name__)
+
+row_batch_size = 10000
+batches_per_worker = 4 # Queue bound is parse_workers * batches_per_worker
+writer_poll_interval = 5 # Seconds
+
+class WriterStoppedError(Exception):
+    """Raised when the sqlite writer process exits before the parsers are done with it"""
+
+# Blocks while the queue is full, as long as the writer is still draining it
+def put_batch(batch_queue, item, writer_stopped):
+    while True:
+        try:
+            batch_queue.put(item, timeout=writer_poll_interval)
+            return
+        except queue.Full:
+            if writer_stopped.is_set():
+                raise WriterStoppedError("sqlite writer exited")
+
+# Multiprocessed
+def parse_dump_worker(url, sha256sums, dumps_directory, keep_dumps, batch_queue,
+                      writer_stopped, tqdm_func, global_tqdm):
+
+    base_name = url.split('/')[-1]
+    dump_file_path = os.path.join(dumps_directory, base_name)
+    db_done_file = dump_file_path + ".dbdone"
+
+    if os.path.exists(db_done_file):
+        global_tqdm.update()
+        return True
+
+    try:
+        download_file(url, dump_file_path, sha256sums.get(base_name))
+    except Exception as ex:
+        logger.info(f"Download failed {ex}, skipping processing.")
+        global_tqdm.update()
+        return False
+
+    rows = []
+    counters = Counter()
+    try:
+        for reddit_post in read_dump_posts(dump_file_path, tqdm_func, counters):
+            row = process_reddit_post_row(reddit_post)
+            if row:
+                rows.append(row)
+
+                if len(rows) == row_batch_size:
+                    put_batch(batch_queue, (dump_file_path, rows), writer_stopped)
+                    rows = []
+
+        if rows:
+            put_batch(batch_queue, (dump_file_path, rows), writer_stopped)
+        put_batch(batch_queue, (dump_file_path, None), writer_stopped)
+    except WriterStoppedError as ex:
+        logger.info(f"{ex}, skipping the rest of '{base_name}'.")
+        global_tqdm.update()
+        return False
+
+    log_parse_counters(counters)
+
+    if not keep_dumps:
+        os.remove(dump_file_path)
+
+    global_tqdm.update()
+    return True
+
+def sqlite_writer(batch_queue, logging_queue):
+    setup_logger_child_process(logging_queue)
+
+    db_engine = get_bulk_load_engine()
+    writer = BulkSubmissionWriter(db_engine)
+
+    # {dump_file_path: (row_count, timer)}
+    in_progress = {}
+    while True:
+        item = batch_queue.get()
+        if item is None:
+            break
+
+        dump_file_path, rows = item
+        if dump_file_path not in in_progress:
+            in_progress[dump_file_path] = (0, Timer().start())
+
+        row_count, timer = in_progress[dump_file_path]
+        if rows is not None:
+            writer.write(rows)
+            in_progress[dump_file_path] = (row_count + len(rows), timer)
+            continue
+
+        # Marker - every batch for this dump has been committed
+        with open(dump_file_path + ".dbdone", "w") as fh:
+            fh.write("Done!")
+
+        del in_progress[dump_file_path]
+        elapsed = timer.stop()
+        rows_per_second = row_count / elapsed if elapsed else 0
+        logger.info(f"Wrote {row_count} rows from '{os.path.basename(dump_file_path)}' "
+                    f"in {elapsed:0.2f}s ({rows_per_second:0.0f} rows/sec).")
+
+    writer.close()
+    db_engine.dispose()
+
+def process_dumps_parallel(url_list, sha256sums, dumps_directory, keep_dumps,
+                           parse_workers, global_tqdm):
+
+    pool = TqdmMultiProcessPool(parse_workers)
+    batch_queue = pool.mp_manager.Queue(parse_workers * batches_per_worker)
+    writer_stopped = pool.mp_manager.Event()
+
+    writer_process = multiprocessing.Process(target=sqlite_writer,
+                                             args=(batch_queue, pool.logging_queue))
+    writer_process.start()
+
+    # We're blocked in pool.map below, so a thread tells the parsers when the writer exits
+    def watch_writer():
+        writer_process.join()
+        writer_stopped.set()
+    threading.Thread(target=watch_writer, daemon=True).start()
+
+    tasks = []
+    for url in url_list:
+        arguments = (url, sha256sums, dumps_directory, keep_dumps, batch_queue, writer_stopped)
+        task = (parse_dump_worker, arguments)
+        tasks.append(task)
+
+    on_done = lambda _ : None
+    on_error = lambda _ : None
+    results = pool.map(global_tqdm, tasks, on_error, on_done)
+
+    logger.info("Parsing complete, waiting for sqlite writer to finish.")
+    try:
+        put_batch(batch_queue, None, writer_stopped)
+    except WriterStoppedError:
+        pass
+    writer_process.join()
+
+    # Writer logging after the pool finished
+    while not pool.logging_queue.empty():
+        logger_record = pool.logging_queue.get()
+        getattr(logger, logger_record.levelname.lower())(logger_record.getMessage())
+
+    if writer_process.exitcode != 0:
+        raise WriterStoppedError(f"sqlite writer exited with code {writer_process.exitcode}, "
+                                 "re-run to resume the unfinished dumps")
+
+    return results
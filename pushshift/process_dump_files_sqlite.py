@@ -9,6 +9,17 @@ object.
 process_dump_file is the entry point, requiring you to specify 'dump_file_path'
 and 'output_directory'. Supports tqdm-multiprocess.
 
+Posts are read with read_dump_posts. Lines that are obviously self posts or have no url are
+rejected with a cheap byte level check before any JSON parsing, and only the fields
+process_reddit_post needs are extracted from the rest (utils.json_codec.loads_projection).
+Pass a collections.Counter as 'counters' to get the number of lines rejected early, fully
+parsed and failed. With 'zstd_threads' above 1, zst dumps made up of multiple frames are
+decompressed in parallel (see utils.archive_stream_readers.ZstdFrameParallelReader).
+
+process_dump_file_bulk is a faster alternative that skips the ORM, batching rows as
+plain tuples and writing them with a single executemany of INSERT OR IGNORE (see
+models.BulkSubmissionWriter). Both log rows/sec on completion for comparison.
+
 metadata = {}
 metadata["id"] = base36.loads(post["id"])
 metadata["subreddit"] = post.get("subreddit")
@@ -17,25 +28,51 @@ metadata["score"] = post.get("score")
 metadata["created_utc"] = datetime.datetime.fromtimestamp(int(post["created_utc"]))
 """
 
-import json
 import os
 import math
 import datetime
+from collections import Counter
 
 import base36
 from sqlalchemy import exc
 
-from .models import RedditSubmission
-from utils.archive_stream_readers import get_archive_stream_reader
+from .models import RedditSubmission, BulkSubmissionWriter, submission_columns
+from utils.archive_stream_readers import get_archive_stream_reader, iterate_lines
+from utils.json_codec import loads_projection
+from utils.utils import Timer
 
 import logging
 logger = logging.getLogger()
 
 million = math.pow(10, 6)
 
-chunk_size = int(16 * million) # Must be larger then the size of any post
+progress_interval = 10000 # Lines
 
-def process_reddit_post(post):
+post_fields = ("is_self", "url", "id", "subreddit", "title", "score", "created_utc")
+
+# Byte patterns for posts process_reddit_post would reject. Only trusted when the key appears
+# once in the line, as crossposts embed their parent post (which can be a self post).
+is_self_key = b'"is_self":'
+is_self_true = (b'"is_self":true', b'"is_self": true')
+url_key = b'"url":'
+url_empty = (b'"url":""', b'"url": ""', b'"url":null', b'"url": null')
+
+def early_reject(line):
+    if line.count(is_self_key) == 1:
+        for pattern in is_self_true:
+            if pattern in line:
+                return True
+
+    if line.count(url_key) == 1:
+        for pattern in url_empty:
+            if pattern in line:
+                return True
+
+    return False
+
+bulk_insert_batch_size = 100000
+
+def process_reddit_post_row(post):
     is_self = post.get("is_self")
     if is_self is None or is_self:
         return None
@@ -44,75 +81,94 @@ def process_reddit_post(post):
     if url is None or url == "":
         return None
 
-    reddit_submission = RedditSubmission()
-    reddit_submission.id = base36.loads(post["id"])
-    reddit_submission.subreddit = post.get("subreddit")
-    reddit_submission.title = post.get("title")
-    reddit_submission.score = post.get("score", 0)
-    reddit_submission.created_utc = datetime.datetime.fromtimestamp(int(post["created_utc"]))
-    reddit_submission.url = url   
+    # Same order as models.submission_columns
+    return (base36.loads(post["id"]),
+            url,
+            post.get("score", 0),
+            post.get("title"),
+            post.get("subreddit"),
+            datetime.datetime.fromtimestamp(int(post["created_utc"])))
+
+def process_reddit_post(post):
+    row = process_reddit_post_row(post)
+    if row is None:
+        return None
+
+    reddit_submission = RedditSubmission(**dict(zip(submission_columns, row)))
 
     return reddit_submission
 
-def process_dump_file(dump_file_path, db_session, tqdm_func):
-    logging.info(f"Processing dump file '{dump_file_path}'")
+def read_dump_posts(dump_file_path, tqdm_func, counters=None, zstd_threads=0):
+    if counters is None:
+        counters = Counter()
+
     dump_file_size = os.path.getsize(dump_file_path)
 
     previous_file_position = 0
-    count = 0
-    insert_batch_size = 100000
-    with get_archive_stream_reader(dump_file_path) as reader, \
+    with get_archive_stream_reader(dump_file_path, threads=zstd_threads) as reader, \
          tqdm_func(total=dump_file_size, unit="byte", unit_scale=1) as progress:
 
         progress.set_description(f"Processing {os.path.basename(dump_file_path)}")
 
-        previous_line = ""
-        while True:
-            chunk = reader.read(chunk_size)
-            if not chunk:
-                break
-
+        for i, line in enumerate(iterate_lines(reader)):
             # Update Progress Bar
-            current_file_position = reader.tell()
-            progress.update(current_file_position - previous_file_position)
-            previous_file_position = current_file_position
+            if i % progress_interval == 0:
+                current_file_position = reader.tell()
+                progress.update(current_file_position - previous_file_position)
+                previous_file_position = current_file_position
+
+            if not line:
+                continue
+
+            if early_reject(line):
+                counters["early_rejected"] += 1
+                continue
 
-            # Process chunk + leftover, ignore possibly incomplete last line
             try:
-                string_data = chunk.decode("utf-8")
-            except UnicodeDecodeError as ex:
-                logger.info(f"Error in position {current_file_position} in file {dump_file_path}")
-                logger.info(ex)
+                post = loads_projection(line, post_fields)
+            except Exception as ex:
+                logger.info(f"JSON decoding failed: {ex}")
+                counters["failed"] += 1
                 continue
-            lines = string_data.split("\n")
-            for i, line in enumerate(lines[:-1]):
-                if i == 0:
-                    line = previous_line + line
 
-                reddit_post = None
+            counters["parsed"] += 1
+            yield post
+
+        progress.update(reader.tell() - previous_file_position)
+
+def log_parse_counters(counters):
+    logging.info(f"Lines rejected early: {counters['early_rejected']}, "
+                 f"parsed: {counters['parsed']}, failed: {counters['failed']}")
+
+def log_insert_rate(row_count, timer):
+    elapsed = timer.stop()
+    rows_per_second = row_count / elapsed if elapsed else 0
+    logging.info(f"Processed {row_count} rows in {elapsed:0.2f}s ({rows_per_second:0.0f} rows/sec).")
+
+def process_dump_file(dump_file_path, db_session, tqdm_func, zstd_threads=0):
+    logging.info(f"Processing dump file '{dump_file_path}'")
+    timer = Timer().start()
+
+    count = 0
+    total_count = 0
+    counters = Counter()
+    for reddit_post in read_dump_posts(dump_file_path, tqdm_func, counters, zstd_threads):
+        reddit_submission = process_reddit_post(reddit_post)
+        if reddit_submission:
+            db_session.add(reddit_submission)
+            count += 1
+            total_count += 1
+
+            if count == bulk_insert_batch_size:
+                logging.info(f"Committing {count} records to db.")
                 try:
-                    reddit_post = json.loads(line)
-                except Exception as ex:
-                    logger.info(f"JSON decoding failed: {ex}")
-                    continue
-  
-                reddit_submission = process_reddit_post(reddit_post)
-                if reddit_submission:
-                    db_session.add(reddit_submission)
-                    count += 1
-
-                    if count == insert_batch_size:    
-                        logging.info(f"Committing {count} records to db.")
-                        try:
-                            db_session.commit()
-                        except exc.IntegrityError:
-                            logger.info(f"Duplicate INSERT, ignoring.")
-                            db_session.rollback()
-                        count = 0
-
-            previous_line = lines[-1]
-
-    if count > 0:    
+                    db_session.commit()
+                except exc.IntegrityError:
+                    logger.info(f"Duplicate INSERT, ignoring.")
+                    db_session.rollback()
+                count = 0
+
+    if count > 0:
         logging.info(f"Committing {count} records to db.")
         try:
             db_session.commit()
@@ -121,4 +177,37 @@ def process_dump_file(dump_file_path, db_session, tqdm_func):
             db_session.rollback()
         count = 0
 
+    log_parse_counters(counters)
+    log_insert_rate(total_count, timer)
+    logging.info("Done with file.")
+
+def process_dump_file_bulk(dump_file_path, db_engine, tqdm_func, zstd_threads=0):
+    logging.info(f"Processing dump file '{dump_file_path}' (bulk insert)")
+    timer = Timer().start()
+
+    writer = BulkSubmissionWriter(db_engine)
+    rows = []
+    total_count = 0
+    inserted_count = 0
+    counters = Counter()
+    for reddit_post in read_dump_posts(dump_file_path, tqdm_func, counters, zstd_threads):
+        row = process_reddit_post_row(reddit_post)
+        if row:
+            rows.append(row)
+
+            if len(rows) == bulk_insert_batch_size:
+                inserted_count += writer.write(rows)
+                total_count += len(rows)
+                rows = []
+
+    if rows:
+        inserted_count += writer.write(rows)
+        total_count += len(rows)
+    writer.close()
+
+    duplicate_count = total_count - inserted_count
+    if duplicate_count:
+        logger.info(f"Ignored {duplicate_count} duplicate rows.")
+    log_parse_counters(counters)
+    log_insert_rate(total_count, timer)
     logging.info("Done with file.")
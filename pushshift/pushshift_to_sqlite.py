@@ -1,7 +1,12 @@
 """
 Builds a list of PushShift submission dump files located in "https://files.pushshift.io/reddit/submissions"
-within the desired date range, and then performs the following steps for each file. Note this can't be done 
-with a multiprocessing pool due to locking issues with sqlite.
+within the desired date range, and then performs the following steps for each file. Sqlite only supports
+a single writer, so by default this is done one file at a time. With --parse_workers the downloading,
+decompression and parsing is spread over a multiprocessing pool feeding a single sqlite writer process,
+see process_dump_files_parallel.py.
+
+The file list is cached in "dumps/file_list_manifest.json" so re-runs don't need to probe
+the server for each month again.
 
 1. Download and verify the file using the available sha256 sums
 2. Process the file, storing the url and relevant Reddit metadata into the sqlite database
@@ -19,10 +24,33 @@ Arguments
     Base directory that will contain the dumps subdirectory created as part of the process.
 --keep_dumps (-kd)
     If specified the dump won't be deleted after successful processing.    
+--bulk_insert (-bulk)
+    If specified rows are written with executemany INSERT OR IGNORE and tuned sqlite
+    pragmas (WAL, synchronous=OFF, larger cache) instead of through the ORM.
+--defer_indexes (-defer)
+    If specified the url and created_utc indexes are dropped before loading and built
+    in one pass once every dump has been processed. Safe to resume, the indexes are
+    dropped again until all .dbdone files exist.
+--composite_index
+    With --defer_indexes, also build the (url, created_utc) composite index at the end.
+--parse_workers (-workers)
+    Number of processes downloading and parsing dumps in parallel, with rows written by a
+    single sqlite writer process (always uses bulk insert). Defaults to 0, processing one
+    file at a time in the main process.
+--prefetch (-prefetch)
+    Number of dumps to download ahead of the one currently being processed. Ignored
+    with --parse_workers, which already downloads in each worker. Defaults to 0.
+--prefetch_reserve
+    Free space in GB to leave on the dumps drive when deciding whether another dump
+    can be prefetched. Defaults to 10.
+--zstd_threads
+    Threads used to decompress .zst dumps made up of multiple frames in parallel. Single
+    frame dumps are always streamed. Ignored with --parse_workers. Defaults to 0.
 """
 
 import datetime
 import os
+import math
 import argparse
 import sys
 
@@ -31,14 +59,36 @@ import cutie
 import tqdm
 
 from .download_pushshift_dumps import build_file_list, get_sha256sums
-from .process_dump_files_sqlite import process_dump_file
-from .models import get_db_session
+from .process_dump_files_sqlite import process_dump_file, process_dump_file_bulk
+from .process_dump_files_parallel import process_dumps_parallel
+from .prefetch_dumps import DumpPrefetcher
+from .models import get_db_session, get_bulk_load_engine
+from .models import drop_secondary_indexes, build_secondary_indexes
+from utils.utils import Timer
 
 import logging
 from utils.logger import setup_logger_tqdm
 logger = logging.getLogger(__name__)
 
-def reddit_processing(url, sha256sums, dumps_directory, keep_dumps):
+billion = math.pow(10, 9)
+
+def process_downloaded_dump(dump_file_path, keep_dumps, bulk_insert, zstd_threads=0):
+    if bulk_insert:
+        db_engine = get_bulk_load_engine()
+        process_dump_file_bulk(dump_file_path, db_engine, tqdm.tqdm, zstd_threads)
+        db_engine.dispose()
+    else:
+        db_session = get_db_session()
+        process_dump_file(dump_file_path, db_session, tqdm.tqdm, zstd_threads)
+
+    with open(dump_file_path + ".dbdone", "w") as fh:
+        fh.write("Done!")
+
+    if not keep_dumps:
+        os.remove(dump_file_path)
+
+def reddit_processing(url, sha256sums, dumps_directory, keep_dumps, bulk_insert=False,
+                      zstd_threads=0):
 
     base_name = url.split('/')[-1]
     dump_file_path = os.path.join(dumps_directory, base_name)
@@ -53,22 +103,43 @@ def reddit_processing(url, sha256sums, dumps_directory, keep_dumps):
         logger.info(f"Download failed {ex}, skipping processing.")
         return False
 
-    db_session = get_db_session()
-    process_dump_file(dump_file_path, db_session, tqdm.tqdm)
+    process_downloaded_dump(dump_file_path, keep_dumps, bulk_insert, zstd_threads)
 
-    with open(db_done_file, "w") as fh:
-        fh.write("Done!")
+    return True
 
-    if not keep_dumps:
-        os.remove(dump_file_path)
+def prefetch_processing(url_list, sha256sums, dumps_directory, keep_dumps, bulk_insert,
+                        prefetch_count, prefetch_reserve, zstd_threads=0):
 
-    return True
+    remaining_urls = []
+    results = []
+    for url in url_list:
+        db_done_file = os.path.join(dumps_directory, url.split('/')[-1]) + ".dbdone"
+        if os.path.exists(db_done_file):
+            results.append(True)
+        else:
+            remaining_urls.append(url)
+
+    prefetcher = DumpPrefetcher(remaining_urls, sha256sums, dumps_directory, prefetch_count,
+                                prefetch_reserve)
+    for url, dump_file_path, downloaded in prefetcher:
+        if downloaded:
+            process_downloaded_dump(dump_file_path, keep_dumps, bulk_insert, zstd_threads)
+        results.append(downloaded)
+
+    return results
 
 parser = argparse.ArgumentParser(description='Download PushShift submission dumps, extra urls')
 parser.add_argument("-s", "--start_period", default="6,2005")
 parser.add_argument("-f", "--finish_period", default=None)
 parser.add_argument("-dir", "--output_directory", default="")
 parser.add_argument("-kd", "--keep_dumps", action='store_true')
+parser.add_argument("-bulk", "--bulk_insert", action='store_true')
+parser.add_argument("-defer", "--defer_indexes", action='store_true')
+parser.add_argument("--composite_index", action='store_true')
+parser.add_argument("-workers", "--parse_workers", type=int, default=0)
+parser.add_argument("-prefetch", "--prefetch", type=int, default=0)
+parser.add_argument("--prefetch_reserve", type=float, default=10)
+parser.add_argument("--zstd_threads", type=int, default=0)
 
 # First available file: https://files.pushshift.io/reddit/submissions/RS_v2_2005-06.xz
 def main():
@@ -104,17 +175,48 @@ def main():
     os.makedirs(dumps_directory, exist_ok=True)
 
     logger.info("Building PushShift submission dump file list...")
-    url_list = build_file_list(start_date, end_date)        
+    manifest_path = os.path.join(dumps_directory, "file_list_manifest.json")
+    url_list = build_file_list(start_date, end_date, manifest_path)        
 
     logger.info("Getting sha256sums")
     sha256sums = get_sha256sums()
 
+    if args.defer_indexes:
+        logger.info("Dropping secondary indexes until all dumps are loaded.")
+        db_engine = get_bulk_load_engine()
+        drop_secondary_indexes(db_engine)
+        db_engine.dispose()
+
     # Download and Process
     logger.info("Commencing download and processing into sqlite.")
-    results = []
-    for url in url_list:
-        result = reddit_processing(url, sha256sums, dumps_directory, args.keep_dumps)
-        results.append(result)
+    if args.parse_workers > 0:
+        with tqdm.tqdm(total=len(url_list), dynamic_ncols=True) as progress:
+            progress.set_description("Dumps")
+            results = process_dumps_parallel(url_list, sha256sums, dumps_directory,
+                                             args.keep_dumps, args.parse_workers, progress)
+    elif args.prefetch > 0:
+        prefetch_reserve = int(args.prefetch_reserve * billion)
+        results = prefetch_processing(url_list, sha256sums, dumps_directory, args.keep_dumps,
+                                      args.bulk_insert, args.prefetch, prefetch_reserve,
+                                      args.zstd_threads)
+    else:
+        results = []
+        for url in url_list:
+            result = reddit_processing(url, sha256sums, dumps_directory, args.keep_dumps,
+                                       args.bulk_insert, args.zstd_threads)
+            results.append(result)
+
+    if args.defer_indexes:
+        if not all(results):
+            logger.info("Some dumps failed, re-run to resume before indexes are built.")
+            return
+
+        logger.info("Building secondary indexes.")
+        timer = Timer().start()
+        db_engine = get_bulk_load_engine()
+        build_secondary_indexes(db_engine, args.composite_index)
+        db_engine.dispose()
+        logger.info(timer.stop_string())
 
 if __name__ == '__main__':    
     main()  
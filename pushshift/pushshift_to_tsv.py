@@ -0,0 +1,130 @@
+"""
+Alternative to pushshift_to_sqlite.py when you only need the URL files. Builds a list of
+PushShift submission dump files within the desired date range, and then performs the
+following steps for each file:
+
+1. Download and verify the file using the available sha256 sums.
+2. Write a sorted, zstd compressed TSV shard of the url and relevant Reddit metadata
+   into the tsv subdirectory (see tsv_shards.py).
+3. Create a .tsvdone file to mark the particular file as being processed, allowing script resume.
+4. Delete the PushShift dump file to save storage space if --keep_dumps not specified.
+
+Afterwards run generate_urls.py with "--data_source tsv", which merges the shards directly
+and supports date ranges.
+
+Arguments
+---------
+--start_period (-s)
+    Month and Year of first pushshift dump. Default: 6,2005
+--finish_period (-f)
+    Month and Year of final pushshift dump. Defaults to current month, ignoring any missing months.
+--output_directory (-dir)
+    Base directory that will contain the dumps and tsv subdirectories created as part of the process.
+--keep_dumps (-kd)
+    If specified the dump won't be deleted after successful processing.
+--prefetch (-prefetch)
+    Number of dumps to download ahead of the one currently being processed. Defaults to 0.
+--prefetch_reserve
+    Free space in GB to leave on the dumps drive when deciding whether another dump
+    can be prefetched. Defaults to 10.
+--zstd_threads
+    Threads used to decompress .zst dumps made up of multiple frames in parallel. Defaults to 0.
+--rows_per_run
+    Rows sorted in memory at once when sorting a shard. Defaults to 1,000,000.
+"""
+
+import datetime
+import os
+import math
+import argparse
+
+import tqdm
+
+from .download_pushshift_dumps import build_file_list, get_sha256sums
+from .prefetch_dumps import DumpPrefetcher
+from .tsv_shards import process_dump_file_tsv
+
+import logging
+from utils.logger import setup_logger_tqdm
+logger = logging.getLogger(__name__)
+
+billion = math.pow(10, 9)
+
+def tsv_processing(url_list, sha256sums, dumps_directory, tsv_directory, keep_dumps,
+                   prefetch_count, prefetch_reserve, zstd_threads, rows_per_run):
+
+    remaining_urls = []
+    results = []
+    for url in url_list:
+        tsv_done_file = os.path.join(dumps_directory, url.split('/')[-1]) + ".tsvdone"
+        if os.path.exists(tsv_done_file):
+            results.append(True)
+        else:
+            remaining_urls.append(url)
+
+    # With prefetch_count 0 this downloads and processes one dump at a time
+    prefetcher = DumpPrefetcher(remaining_urls, sha256sums, dumps_directory, prefetch_count,
+                                prefetch_reserve)
+    for url, dump_file_path, downloaded in prefetcher:
+        results.append(downloaded)
+        if not downloaded:
+            continue
+
+        process_dump_file_tsv(dump_file_path, tsv_directory, tqdm.tqdm, zstd_threads, rows_per_run)
+
+        with open(dump_file_path + ".tsvdone", "w") as fh:
+            fh.write("Done!")
+
+        if not keep_dumps:
+            os.remove(dump_file_path)
+
+    return results
+
+parser = argparse.ArgumentParser(description='Download PushShift submission dumps, write sorted tsv shards')
+parser.add_argument("-s", "--start_period", default="6,2005")
+parser.add_argument("-f", "--finish_period", default=None)
+parser.add_argument("-dir", "--output_directory", default="")
+parser.add_argument("-kd", "--keep_dumps", action='store_true')
+parser.add_argument("-prefetch", "--prefetch", type=int, default=0)
+parser.add_argument("--prefetch_reserve", type=float, default=10)
+parser.add_argument("--zstd_threads", type=int, default=0)
+parser.add_argument("--rows_per_run", type=int, default=1000000)
+
+def main():
+    logfile_path = "pushshift_to_tsv.log"
+    setup_logger_tqdm(logfile_path) # Logger will write messages using tqdm.write
+
+    args = parser.parse_args()
+
+    start_month, start_year = tuple(map(int,args.start_period.split(",")))
+    start_date = datetime.datetime(start_year, start_month, 1)
+
+    if args.finish_period:
+        finish_month, finish_year = tuple(map(int,args.finish_period.split(",")))
+        end_date = datetime.datetime(finish_year, finish_month, 1)
+    else:
+        end_date = datetime.datetime.now()
+
+    logger.info("Running Script - PushShift submission dumps to tsv shards")
+    logger.info(start_date.strftime("Start Period: %m-%Y"))
+    logger.info(end_date.strftime("End Period: %m-%Y"))
+
+    dumps_directory = os.path.join(args.output_directory, "dumps")
+    tsv_directory = os.path.join(args.output_directory, "tsv")
+    os.makedirs(dumps_directory, exist_ok=True)
+    os.makedirs(tsv_directory, exist_ok=True)
+
+    logger.info("Building PushShift submission dump file list...")
+    manifest_path = os.path.join(dumps_directory, "file_list_manifest.json")
+    url_list = build_file_list(start_date, end_date, manifest_path)
+
+    logger.info("Getting sha256sums")
+    sha256sums = get_sha256sums()
+
+    logger.info("Commencing download and processing into tsv shards.")
+    prefetch_reserve = int(args.prefetch_reserve * billion)
+    tsv_processing(url_list, sha256sums, dumps_directory, tsv_directory, args.keep_dumps,
+                   args.prefetch, prefetch_reserve, args.zstd_threads, args.rows_per_run)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""
+Sorted TSV shards, an alternative to the sqlite database for generate_urls.py.
+
+process_dump_file_tsv writes one zstd compressed shard per PushShift dump, containing
+the following tab separated columns for each link submission:
+
+url, id, score, title, subreddit, created_utc
+
+Rows are sorted by url then id (using url_grouping.external_sort, so memory stays bounded
+on large months). id is converted from base36 and created_utc is the raw unix timestamp.
+Tabs, newlines and backslashes inside fields are escaped, and None is stored as \\N.
+
+read_sorted_shards merges any number of shards into a single stream sorted by url, in the
+same (id, url, score, title, subreddit, created_utc) format as generate_urls.get_from_db,
+optionally filtering by created_utc. Submissions found in more than one dump are only
+returned once, matching the INSERT OR IGNORE behaviour of the database.
+"""
+
+import os
+import re
+import heapq
+import datetime
+from collections import Counter
+
+import zstandard
+from dateutil.relativedelta import *
+
+from .process_dump_files_sqlite import read_dump_posts, process_reddit_post_row, log_parse_counters
+from .url_grouping import external_sort
+from utils.archive_stream_readers import iterate_lines
+from utils.utils import Timer
+
+import logging
+logger = logging.getLogger(__name__)
+
+null_field = b"\\N"
+escapes = [(b"\\", b"\\\\"), (b"\t", b"\\t"), (b"\n", b"\\n"), (b"\r", b"\\r")]
+unescape_regex = re.compile(rb"\\(.)")
+unescapes = {b"\\": b"\\", b"t": b"\t", b"n": b"\n", b"r": b"\r"}
+
+shard_read_size = 1024 * 1024 # Many shards are open at once when merging
+shard_month_regex = re.compile(r"(\d{4})-(\d{2})")
+
+def escape_field(value):
+    if value is None:
+        return null_field
+
+    field = str(value).encode("utf-8")
+    for character, escaped in escapes:
+        field = field.replace(character, escaped)
+    return field
+
+def unescape_field(field):
+    if field == null_field:
+        return None
+
+    if b"\\" in field:
+        field = unescape_regex.sub(lambda match: unescapes[match.group(1)], field)
+    return field.decode("utf-8")
+
+def int_or_none(field):
+    return None if field is None else int(field)
+
+def write_tsv_shard(rows, shard_path):
+    cctx = zstandard.ZstdCompressor(level=3)
+    count = 0
+    with open(shard_path, "wb") as fh, cctx.stream_writer(fh) as compressor:
+        for submission_id, url, score, title, subreddit, created_utc in rows:
+            fields = (url, submission_id, score, title, subreddit, created_utc)
+            compressor.write(b"\t".join(map(escape_field, fields)) + b"\n")
+            count += 1
+    return count
+
+def read_tsv_shard(shard_path, start_date=None, end_date=None):
+    with open(shard_path, "rb") as fh:
+        reader = zstandard.ZstdDecompressor().stream_reader(fh, read_across_frames=True)
+        for line in iterate_lines(reader, shard_read_size):
+            if not line:
+                continue
+
+            url, submission_id, score, title, subreddit, created_utc = \
+                map(unescape_field, line.split(b"\t"))
+
+            created_utc = datetime.datetime.fromtimestamp(int(created_utc))
+            if start_date and created_utc < start_date:
+                continue
+            if end_date and created_utc >= end_date:
+                continue
+
+            yield (int(submission_id), url, int_or_none(score), title, subreddit, created_utc)
+
+# Dumps are monthly so we can skip shards well outside the range without reading them
+def shard_in_range(shard_path, start_date, end_date):
+    match = shard_month_regex.search(os.path.basename(shard_path))
+    if not match:
+        return True
+
+    shard_month = datetime.datetime(int(match.group(1)), int(match.group(2)), 1)
+    if start_date and shard_month + relativedelta(months=+2) <= start_date:
+        return False
+    if end_date and shard_month - relativedelta(months=+1) >= end_date:
+        return False
+    return True
+
+def read_sorted_shards(shard_paths, start_date=None, end_date=None):
+    shard_paths = [path for path in shard_paths if shard_in_range(path, start_date, end_date)]
+    logger.info(f"Merging {len(shard_paths)} tsv shards.")
+
+    shards = [read_tsv_shard(path, start_date, end_date) for path in shard_paths]
+    previous_key = None
+    for row in heapq.merge(*shards, key=lambda row: (row[1], row[0])):
+        key = (row[1], row[0])
+        if key == previous_key:
+            continue
+        previous_key = key
+        yield row
+
+def get_tsv_shard_path(dump_file_path, tsv_directory):
+    base_name = os.path.basename(dump_file_path).rsplit(".", 1)[0]
+    return os.path.join(tsv_directory, base_name + ".tsv.zst")
+
+def process_dump_file_tsv(dump_file_path, tsv_directory, tqdm_func, zstd_threads=0,
+                          rows_per_run=1000000):
+    logging.info(f"Processing dump file '{dump_file_path}' (tsv)")
+    timer = Timer().start()
+
+    counters = Counter()
+    def rows():
+        for reddit_post in read_dump_posts(dump_file_path, tqdm_func, counters, zstd_threads):
+            row = process_reddit_post_row(reddit_post)
+            if row:
+                created_utc = int(row[5].timestamp())
+                yield row[:5] + (created_utc,)
+
+    shard_path = get_tsv_shard_path(dump_file_path, tsv_directory)
+    temp_directory = shard_path + "_runs"
+    temp_shard_path = shard_path + ".tmp" # Never leave a partial shard behind
+    row_count = write_tsv_shard(external_sort(rows(), temp_directory, rows_per_run), temp_shard_path)
+    os.replace(temp_shard_path, shard_path)
+    os.rmdir(temp_directory)
+
+    log_parse_counters(counters)
+    elapsed = timer.stop()
+    logging.info(f"Wrote {row_count} rows to '{os.path.basename(shard_path)}' in {elapsed:0.2f}s.")
@@ -0,0 +1,141 @@
+"""
+Used by generate_urls.py to sort submission rows by url without asking sqlite for a
+global ORDER BY url. With a date range sqlite can't use the url index, so it builds a
+temporary B-tree of the entire range - slow and heavy on the temp directory.
+
+Rows are (id, url, score, title, subreddit, created_utc) tuples as returned by the
+unordered query in generate_urls.get_from_db. Both functions below yield them sorted by
+url, ties broken by submission id (the same order as a scan of the url index), so
+generate_urls produces identical output whichever is used.
+
+external_sort
+    Classic external merge sort. Rows are buffered up to 'rows_per_run', sorted in memory
+    and spilled to a temporary run file. The runs are then combined with a k-way merge.
+    Memory is bounded by rows_per_run.
+
+hash_partition_sort
+    Rows are split into 'partitions' bucket files by a hash of the url, so all
+    submissions for a url land in the same bucket. Each bucket is then loaded and sorted
+    in memory by a pool of processes, and the sorted buckets are merged. Memory is bounded
+    by the size of the largest bucket, and the sorting uses several cores.
+
+Run and bucket files are streams of pickled row batches.
+"""
+
+import os
+import heapq
+import pickle
+import zlib
+from operator import itemgetter
+
+import tqdm
+from tqdm_multiprocess import TqdmMultiProcessPool
+
+import logging
+logger = logging.getLogger(__name__)
+
+sort_key = itemgetter(1, 0) # url, id
+pickle_batch_size = 10000
+
+def write_rows(rows, file_path):
+    with open(file_path, "wb") as fh:
+        for i in range(0, len(rows), pickle_batch_size):
+            pickle.dump(rows[i:i + pickle_batch_size], fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+def read_rows(file_path):
+    with open(file_path, "rb") as fh:
+        while True:
+            try:
+                batch = pickle.load(fh)
+            except EOFError:
+                break
+            yield from batch
+
+def merge_runs(run_paths):
+    try:
+        yield from heapq.merge(*[read_rows(run_path) for run_path in run_paths], key=sort_key)
+    finally:
+        for run_path in run_paths:
+            os.remove(run_path)
+
+def external_sort(rows, temp_directory, rows_per_run=1000000):
+    os.makedirs(temp_directory, exist_ok=True)
+
+    run_paths = []
+    run = []
+    for row in rows:
+        run.append(row)
+        if len(run) == rows_per_run:
+            run.sort(key=sort_key)
+            run_path = os.path.join(temp_directory, f"run_{len(run_paths)}.pkl")
+            write_rows(run, run_path)
+            run_paths.append(run_path)
+            run = []
+
+    # Last run stays in memory
+    run.sort(key=sort_key)
+    logger.info(f"Merging {len(run_paths) + 1} sorted runs.")
+    yield from heapq.merge(run, merge_runs(run_paths), key=sort_key)
+
+def get_partition(url, partitions):
+    return zlib.crc32(url.encode("utf-8")) % partitions # hash() is salted per process
+
+class PartitionWriter:
+    def __init__(self, temp_directory, partitions):
+        self.partitions = partitions
+        self.paths = [os.path.join(temp_directory, f"bucket_{i}.pkl") for i in range(partitions)]
+        self.file_handles = [open(path, "wb") for path in self.paths]
+        self.buffers = [[] for _ in range(partitions)]
+
+    def flush(self, partition):
+        pickle.dump(self.buffers[partition], self.file_handles[partition],
+                    protocol=pickle.HIGHEST_PROTOCOL)
+        self.buffers[partition] = []
+
+    def add(self, row):
+        partition = get_partition(row[1], self.partitions)
+        self.buffers[partition].append(row)
+        if len(self.buffers[partition]) == pickle_batch_size:
+            self.flush(partition)
+
+    def close(self):
+        for partition in range(self.partitions):
+            if self.buffers[partition]:
+                self.flush(partition)
+            self.file_handles[partition].close()
+
+# Multiprocessed
+def sort_bucket(bucket_path, tqdm_func, global_tqdm):
+    rows = list(read_rows(bucket_path))
+    rows.sort(key=sort_key)
+
+    sorted_path = bucket_path.replace(".pkl", "_sorted.pkl")
+    write_rows(rows, sorted_path)
+    os.remove(bucket_path)
+
+    global_tqdm.update()
+    return sorted_path
+
+def hash_partition_sort(rows, temp_directory, partitions=64, process_count=4):
+    os.makedirs(temp_directory, exist_ok=True)
+
+    logger.info(f"Splitting rows into {partitions} buckets.")
+    writer = PartitionWriter(temp_directory, partitions)
+    for row in rows:
+        writer.add(row)
+    writer.close()
+
+    logger.info("Sorting buckets.")
+    pool = TqdmMultiProcessPool(process_count)
+    tasks = [(sort_bucket, (bucket_path,)) for bucket_path in writer.paths]
+    on_done = lambda _ : None
+    on_error = lambda _ : None
+    with tqdm.tqdm(total=partitions, dynamic_ncols=True) as progress:
+        progress.set_description("Sorting buckets")
+        sorted_paths = pool.map(progress, tasks, on_error, on_done)
+
+    if None in sorted_paths:
+        raise Exception("Sorting a bucket failed, see log.")
+
+    # Buckets hold disjoint urls so merging them gives the global url order
+    yield from merge_runs(sorted_paths)
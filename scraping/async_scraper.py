@@ -0,0 +1,227 @@
+"""
+Asynchronous scraping engine, used by scrape_urls.py with "--engine async".
+
+With the process pool engine every process blocks in newspaper's download for up to
+request_timeout seconds, so throughput is capped by the process count rather than the
+bandwidth, and each process costs a lot of RAM. Here a single asyncio event loop (running
+in a background thread) fetches pages with aiohttp, holding up to max_connections requests
+in flight. The downloaded html is handed to a small process pool for parsing, so I/O
+concurrency and parse parallelism are sized independently. parse defaults to
+scrapers.newspaper_parse, pass scrapers.fast_parse for the fast extractor.
+
+AsyncScraper.scrape takes (url, reddit_meta) entries and yields the same (url, (text, meta,
+success)) results as scrape_urls.download, in completion order. Entries are expected to
+have been through filter.filter_url_entries already.
+
+URLs are handed out by a DomainScheduler (domain_scheduler.py), interleaving hosts and
+capping the requests in flight per host at per_domain_limit. The connector keeps up to the
+same number of keep-alive connections per host, so requests to popular domains reuse
+connections rather than paying a fresh TLS handshake each time.
+
+With cache_directory set, responses are kept as received in a ResponseCache
+(response_cache.py) and cached pages are never fetched again. The cache runs on its own
+thread, off the event loop. In replay mode the network isn't touched at all,
+urls missing from the cache fail with CacheMissError.
+
+Requests are tracked per host by a HostHealth (host_health.py). Dead hosts and hosts that
+keep failing are cut off for a while, failing their urls straight away instead of after a
+full request_timeout, and hosts with a latency history get a tighter adaptive timeout.
+
+Like newspaper's download, redirects are followed and any status >= 400 is a failure.
+Responses that aren't html or are bigger than max_bytes are dropped as soon as the headers
+(or the first max_bytes of the body) arrive, see scrapers.check_response_headers.
+Pages are decoded with the charset from the Content-Type header. Without one they are
+passed on as bytes for the parser to sniff, the same as the pool engine (see
+scrapers.decode_body).
+"""
+
+import time
+import queue
+import socket
+import asyncio
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import aiohttp
+import newspaper
+
+from scraping.scrapers import newspaper_parse, check_response_headers, ResponseRejectedError
+from scraping.scrapers import default_max_bytes, decode_body
+from scraping.domain_scheduler import DomainScheduler
+from scraping.response_cache import ResponseCache, CacheMissError
+from scraping.host_health import HostHealth
+
+import logging
+logger = logging.getLogger(__name__)
+
+def add_reddit_meta(meta, reddit_meta):
+    meta["reddit_id"] = reddit_meta["id"]
+    meta["subreddit"] = reddit_meta["subreddit"]
+    meta["reddit_score"] = reddit_meta["score"]
+    meta["reddit_title"] = reddit_meta["title"]
+    meta["reddit_created_utc"] = reddit_meta["created_utc"]
+
+class AsyncScraper:
+    def __init__(self, max_connections=1000, parse_processes=None, request_timeout=30,
+                 per_domain_limit=4, cache_directory=None, cache_max_bytes=None, replay=False,
+                 min_timeout=5, failure_threshold=5, dns_ttl=300, max_bytes=default_max_bytes,
+                 parse=newspaper_parse):
+        self.max_connections = max_connections
+        self.per_domain_limit = per_domain_limit
+        self.parse_processes = parse_processes
+        self.request_timeout = request_timeout
+        self.headers = {"User-Agent": newspaper.Config().browser_user_agent}
+        self.cache_directory = cache_directory
+        self.cache_max_bytes = cache_max_bytes
+        self.replay = replay
+        self.cache = None # Only used from cache_executor's thread
+        self.cache_executor = None
+        self.host_health = HostHealth(request_timeout, min_timeout, failure_threshold)
+        self.dns_ttl = dns_ttl
+        self.max_bytes = max_bytes
+        self.parse = parse
+
+    async def fetch(self, session, url, host):
+        self.host_health.check(host)
+        timeout = aiohttp.ClientTimeout(total=self.host_health.get_timeout(host))
+        start = time.monotonic()
+
+        try:
+            async with session.get(url, timeout=timeout) as response:
+                response.raise_for_status()
+                check_response_headers(response.headers.get("Content-Type"),
+                                       response.headers.get("Content-Length"), self.max_bytes)
+
+                chunks = []
+                size = 0
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    size += len(chunk)
+                    if self.max_bytes and size > self.max_bytes:
+                        raise ResponseRejectedError("too_large", f"over {self.max_bytes} bytes")
+                    chunks.append(chunk)
+
+                body = b"".join(chunks)
+                charset = response.charset
+        except (aiohttp.ClientResponseError, ResponseRejectedError): # The host itself is fine
+            self.host_health.record_success(host, time.monotonic() - start)
+            raise
+        except aiohttp.ClientConnectorError as ex:
+            if isinstance(ex.os_error, (socket.gaierror, ConnectionRefusedError)):
+                self.host_health.record_dead(host, repr(ex.os_error))
+            else:
+                self.host_health.record_failure(host, repr(ex))
+            raise
+        except (asyncio.TimeoutError, aiohttp.ServerConnectionError, aiohttp.ClientOSError) as ex:
+            self.host_health.record_failure(host, repr(ex))
+            raise
+
+        self.host_health.record_success(host, time.monotonic() - start)
+        return body, charset
+
+    async def get_html(self, session, url, host):
+        loop = asyncio.get_running_loop()
+        if self.cache:
+            cached = await loop.run_in_executor(self.cache_executor, self.cache.get, url)
+            if cached is not None:
+                return decode_body(*cached)
+            if self.replay:
+                raise CacheMissError(url)
+
+        body, charset = await self.fetch(session, url, host)
+        if self.cache:
+            await loop.run_in_executor(self.cache_executor, self.cache.put, url, body, charset)
+        return decode_body(body, charset)
+
+    async def scrape_entry(self, session, parse_pool, domain, url_entry):
+        url, reddit_meta = url_entry
+        t1 = time.time()
+
+        try:
+            html = await self.get_html(session, url, domain)
+        except Exception as ex: # asyncio.TimeoutError and aiohttp.ClientError mostly
+            return None, ex, False
+
+        loop = asyncio.get_running_loop()
+        text, meta, success = await loop.run_in_executor(parse_pool, self.parse, url, html)
+        if not success or text is None or text.strip() == "":
+            return text, meta, False
+
+        meta["elapsed"] = time.time() - t1
+        add_reddit_meta(meta, reddit_meta)
+        return text, meta, True
+
+    async def run(self, url_entries, results):
+        scheduler = DomainScheduler(url_entries, self.per_domain_limit)
+        domain_freed = asyncio.Event()
+
+        # Bounds downloads plus parses waiting on the pool, and therefore memory
+        slots = asyncio.Semaphore(self.max_connections)
+        connector = aiohttp.TCPConnector(limit=self.max_connections,
+                                         limit_per_host=self.per_domain_limit,
+                                         use_dns_cache=self.dns_ttl > 0,
+                                         ttl_dns_cache=self.dns_ttl or None)
+
+        async def scrape_slot(session, parse_pool, domain, url_entry):
+            try:
+                result = await self.scrape_entry(session, parse_pool, domain, url_entry)
+                results.put((url_entry[0], result))
+            finally:
+                scheduler.done(domain)
+                domain_freed.set()
+                slots.release()
+
+        with ProcessPoolExecutor(self.parse_processes) as parse_pool:
+            async with aiohttp.ClientSession(connector=connector, headers=self.headers) as session:
+                tasks = set()
+                while len(scheduler):
+                    await slots.acquire()
+
+                    # Every remaining domain at its limit, wait for one of their requests
+                    scheduled = scheduler.next()
+                    while scheduled is None:
+                        domain_freed.clear()
+                        await domain_freed.wait()
+                        scheduled = scheduler.next()
+
+                    domain, url_entry = scheduled
+                    task = asyncio.create_task(scrape_slot(session, parse_pool, domain, url_entry))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+                if tasks:
+                    await asyncio.gather(*tasks)
+
+        self.host_health.publish() # For scrape_urls to report
+
+    def run_thread(self, url_entries, results):
+        try:
+            if self.cache_directory:
+                self.cache_executor = ThreadPoolExecutor(1)
+                self.cache = self.cache_executor.submit(ResponseCache, self.cache_directory,
+                                                        self.cache_max_bytes).result()
+            asyncio.run(self.run(url_entries, results))
+        except BaseException as ex:
+            results.put(ex)
+        finally:
+            if self.cache:
+                self.cache_executor.submit(self.cache.close).result()
+                self.cache = None
+            if self.cache_executor:
+                self.cache_executor.shutdown()
+                self.cache_executor = None
+            results.put(None)
+
+    def scrape(self, url_entries):
+        results = queue.Queue()
+        thread = threading.Thread(target=self.run_thread, args=(url_entries, results), daemon=True)
+        thread.start()
+
+        while True:
+            result = results.get()
+            if result is None:
+                break
+            if isinstance(result, BaseException):
+                raise result
+            yield result
+
+        thread.join()
@@ -0,0 +1,85 @@
+"""
+DNS resolution cache shared by the scrape pool processes.
+
+newspaper downloads through requests/urllib3, which resolve every connection with
+socket.getaddrinfo, so each of the pool processes looks up the same news domains
+thousands of times per batch. install_dns_cache (the pool initializer) replaces
+socket.getaddrinfo in a worker with DnsCache.getaddrinfo, backed by a dict living in a
+multiprocessing Manager so a lookup made by one worker serves all of them.
+
+getaddrinfo doesn't expose record TTLs, so answers are kept for a fixed ttl and
+failures (socket.gaierror) for negative_ttl. Expired entries are never served, they are
+replaced on the next lookup and purge drops them in bulk between batches.
+
+resolve defaults to the original socket.getaddrinfo, pass another function (a local
+stub resolver for example) to run without a network. It goes through the pool
+initializer, so it has to be a module level function.
+
+Hit and miss counts are kept in each process and published to a second shared dict when
+the process exits, so lookups only touch the Manager for the cache itself. scrape_urls
+runs a fresh pool per batch and clears the stats after reporting them, see get_stats.
+"""
+
+import os
+import time
+import socket
+from multiprocessing import util
+
+resolve_uncached = socket.getaddrinfo
+
+class DnsCache:
+    def __init__(self, cache, stats, ttl=300, negative_ttl=60, resolve=None):
+        self.cache = cache
+        self.stats = stats
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.resolve = resolve or resolve_uncached
+        self.hits = 0
+        self.misses = 0
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        key = (host, port, family, type, proto, flags)
+        entry = self.cache.get(key)
+        if entry and entry[0] > time.time():
+            self.hits += 1
+            expires, addresses, error_args = entry
+            if error_args is not None:
+                raise socket.gaierror(*error_args)
+            return addresses
+
+        self.misses += 1
+        try:
+            addresses = self.resolve(host, port, family, type, proto, flags)
+        except socket.gaierror as ex:
+            self.cache[key] = (time.time() + self.negative_ttl, None, ex.args)
+            raise
+
+        self.cache[key] = (time.time() + self.ttl, addresses, None)
+        return addresses
+
+    # Each process only writes its own entry, so no lock is needed
+    def publish(self):
+        self.stats[os.getpid()] = (self.hits, self.misses)
+
+    def purge(self):
+        now = time.time()
+        expired = [key for key, entry in self.cache.items() if entry[0] <= now]
+        for key in expired:
+            self.cache.pop(key, None)
+        return len(expired)
+
+# Returns (hits, misses) summed over every process published since the stats were cleared
+def get_stats(stats):
+    hits = 0
+    misses = 0
+    for process_hits, process_misses in stats.values():
+        hits += process_hits
+        misses += process_misses
+    return hits, misses
+
+# Pool initializer. The stats are published when the worker exits, which only happens on
+# Pool.close (a terminated worker publishes nothing).
+def install_dns_cache(cache, stats, ttl, negative_ttl, resolve=None):
+    dns_cache = DnsCache(cache, stats, ttl, negative_ttl, resolve)
+    socket.getaddrinfo = dns_cache.getaddrinfo
+    util.Finalize(None, dns_cache.publish, exitpriority=10)
@@ -0,0 +1,67 @@
+"""
+Politeness scheduling for the async scraping engine.
+
+URL files are sorted by url, so neighbouring entries usually share a domain. Fed in
+order, popular news domains receive hundreds of simultaneous requests (and rate limit or
+block us) while the rest of the connection pool waits behind them.
+
+DomainScheduler groups the entries of a batch by host and hands them out round robin
+across hosts, never allowing more than per_domain_limit requests in flight for the same
+host. Hosts at their limit are skipped until one of their requests completes, so the
+global pool stays busy with other hosts. The aiohttp connector keeps a keep-alive pool per
+host, so consecutive requests to a host reuse connections instead of new TLS handshakes.
+"""
+
+from collections import deque, Counter
+from urllib.parse import urlsplit
+
+def get_domain(url):
+    try:
+        return urlsplit(url).hostname or ""
+    except ValueError:
+        return ""
+
+class DomainScheduler:
+    def __init__(self, url_entries, per_domain_limit=4):
+        if per_domain_limit < 1:
+            raise ValueError(f"per_domain_limit must be at least 1, got {per_domain_limit}")
+
+        self.per_domain_limit = per_domain_limit
+        self.pending = {}
+        for url_entry in url_entries:
+            domain = get_domain(url_entry[0])
+            self.pending.setdefault(domain, deque()).append(url_entry)
+
+        self.pending_count = sum(len(entries) for entries in self.pending.values())
+        self.in_flight = Counter()
+        self.ready = deque(self.pending) # Domains with entries left and below their limit
+
+    def __len__(self):
+        return self.pending_count
+
+    # Returns (domain, url_entry), or None if every remaining domain is at its limit
+    def next(self):
+        if not self.ready:
+            return None
+
+        domain = self.ready.popleft()
+        entries = self.pending[domain]
+        url_entry = entries.popleft()
+        self.pending_count -= 1
+        self.in_flight[domain] += 1
+
+        if not entries:
+            del self.pending[domain]
+        elif self.in_flight[domain] < self.per_domain_limit:
+            self.ready.append(domain) # Back of the queue, interleaving domains
+
+        return domain, url_entry
+
+    def done(self, domain):
+        at_limit = self.in_flight[domain] == self.per_domain_limit
+        self.in_flight[domain] -= 1
+        if not self.in_flight[domain]:
+            del self.in_flight[domain]
+
+        if at_limit and domain in self.pending:
+            self.ready.append(domain)
@@ -1,5 +1,16 @@
+"""
+URL exclusion heuristics. scrape_urls runs filter_url_entries over each batch as it is
+loaded, so excluded URLs never reach the scrape pool.
+
+Registered domain splits are memoized per host, a batch is full of repeats of the same
+few thousand sites and tldextract is the bulk of the cost. Domain and extension matches
+are single set lookups.
+"""
+
 import tldextract
 import re
+from functools import lru_cache
+from urllib.parse import urlsplit
 
 import logging
 logger = logging.getLogger("filelock")
@@ -107,22 +118,41 @@ exclude_extensions = (
     '.7z'
 )
 
-def should_exclude(url):
+exclude_extension_set = frozenset(exclude_extensions)
+
+# Returns (full domain, registered domain) for a host
+@lru_cache(maxsize=2**16)
+def split_domain(host):
+    ext = tldextract.extract(host)
+    domain = '.'.join([x for x in (ext.subdomain, ext.domain, ext.suffix) if x])
+    basedomain = '.'.join((ext.domain, ext.suffix))
+    return domain, basedomain
 
-    ext = tldextract.extract(url)
-    domain = '.'.join([x for x in ext if x])
-    basedomain = '.'.join(ext[-2:])
+def should_exclude(url):
 
     # Ignore non-URLs
     if len(url) <= 8 or ' ' in url or re.match(url_regex, url) is None:
         return True
 
+    try:
+        host = urlsplit(url).hostname or ''
+    except ValueError:
+        return True
+
     # Ignore excluded domains
+    domain, basedomain = split_domain(host)
     if basedomain in exclude_domains or domain in exclude_domains:
         return True
 
-    # Ignore case-insensitive matches for excluded extensions
-    if url.lower().split('?')[0].endswith(exclude_extensions):
+    # Ignore case-insensitive matches for excluded extensions. Every extension has a single
+    # leading dot, so only the part from the last dot can match.
+    path = url.lower().split('?')[0]
+    if path[path.rfind('.'):] in exclude_extension_set:
         return True
 
-    return False
\ No newline at end of file
+    return False
+
+# Returns (url entries to scrape, excluded count) for a batch of (url, reddit_meta) entries
+def filter_url_entries(url_entries):
+    kept = [url_entry for url_entry in url_entries if not should_exclude(url_entry[0])]
+    return kept, len(url_entries) - len(kept)
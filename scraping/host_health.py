@@ -0,0 +1,150 @@
+"""
+Per-host health tracking for both scraping engines. With the async engine every request
+goes through the one event loop, so a single HostHealth is shared by all of them. The pool
+engine's processes each get a HostHealth from install_host_health (the pool initializer)
+backed by a dict living in a multiprocessing Manager, so a host cut off by one worker is
+skipped by all of them. States are read and written back whole, two workers updating the
+same host at once can lose a latency sample or a failure, which only delays a cutoff.
+
+Dead domains and tarpits otherwise cost a full request_timeout for each of their urls.
+Here a host is cut off (requests fail straight away with HostUnavailableError):
+- for dead_cooldown seconds after a DNS failure or a refused connection
+- for cooldown seconds after failure_threshold consecutive timeouts or connection errors.
+  Once the cooldown is over requests are let through again, the next failure cuts the host
+  off once more while a success resets it.
+
+Hosts with at least min_samples recent successful requests get an adaptive timeout of
+timeout_multiplier times the latency percentile, clamped to [min_timeout, max_timeout].
+Everything else uses max_timeout, the --request_timeout.
+
+URLs failed fast and hosts cut off are counted per process and handed to a stats dict by
+publish, the async engine after each batch and the pool processes when they exit (a
+second Manager dict), see get_stats.
+
+The cutoff times are time.monotonic values, which are system wide, so they hold across
+the pool processes.
+"""
+
+import os
+import time
+from collections import deque
+from multiprocessing import util
+
+class HostUnavailableError(Exception):
+    """Raised for requests to a host that is currently cut off"""
+
+class HostState:
+    __slots__ = ("latencies", "consecutive_failures", "unavailable_until", "reason")
+
+    def __init__(self, latency_samples):
+        self.latencies = deque(maxlen=latency_samples)
+        self.consecutive_failures = 0
+        self.unavailable_until = 0
+        self.reason = None
+
+class HostHealth:
+    def __init__(self, max_timeout=30, min_timeout=5, failure_threshold=5, cooldown=300,
+                 dead_cooldown=3600, latency_samples=20, min_samples=5, percentile=0.95,
+                 timeout_multiplier=3, hosts=None, stats=None):
+        self.max_timeout = max_timeout
+        self.min_timeout = min(min_timeout, max_timeout)
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.dead_cooldown = dead_cooldown
+        self.latency_samples = latency_samples
+        self.min_samples = min_samples
+        self.percentile = percentile
+        self.timeout_multiplier = timeout_multiplier
+        self.hosts = {} if hosts is None else hosts
+        self.stats = {} if stats is None else stats
+        self.fast_fail_count = 0
+        self.cutoff_count = 0
+
+    # With a shared dict this is a copy, record_* write it back with set_state
+    def get_state(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            state = HostState(self.latency_samples)
+        return state
+
+    def set_state(self, host, state):
+        self.hosts[host] = state
+
+    def check(self, host):
+        state = self.hosts.get(host)
+        if state and state.unavailable_until > time.monotonic():
+            self.fast_fail_count += 1
+            raise HostUnavailableError(f"{host}: {state.reason}")
+
+    def get_timeout(self, host):
+        state = self.hosts.get(host)
+        if not state or len(state.latencies) < self.min_samples:
+            return self.max_timeout
+
+        latencies = sorted(state.latencies)
+        latency = latencies[int(self.percentile * (len(latencies) - 1))]
+        timeout = latency * self.timeout_multiplier
+        return max(self.min_timeout, min(timeout, self.max_timeout))
+
+    # Any response counts, an error status still means the host is up
+    def record_success(self, host, elapsed):
+        state = self.get_state(host)
+        state.latencies.append(elapsed)
+        state.consecutive_failures = 0
+        self.set_state(host, state)
+
+    def cut_off(self, state, cooldown):
+        now = time.monotonic()
+        if state.unavailable_until <= now: # Not for requests sent before an earlier cutoff
+            self.cutoff_count += 1
+        state.unavailable_until = now + cooldown
+
+    # Timeouts, resets and other connection errors
+    def record_failure(self, host, reason):
+        state = self.get_state(host)
+        state.consecutive_failures += 1
+        if state.consecutive_failures >= self.failure_threshold:
+            self.cut_off(state, self.cooldown)
+            state.reason = f"{state.consecutive_failures} consecutive failures, last: {reason}"
+        self.set_state(host, state)
+
+    # DNS failures and refused connections
+    def record_dead(self, host, reason):
+        state = self.get_state(host)
+        state.consecutive_failures += 1
+        self.cut_off(state, self.dead_cooldown)
+        state.reason = reason
+        self.set_state(host, state)
+
+    # Adds the counts since the last publish to this process's entry in stats. Each
+    # process only writes its own entry, so no lock is needed.
+    def publish(self):
+        fast_fail_count, cutoff_count = self.stats.get(os.getpid(), (0, 0))
+        self.stats[os.getpid()] = (fast_fail_count + self.fast_fail_count,
+                                   cutoff_count + self.cutoff_count)
+        self.fast_fail_count = 0
+        self.cutoff_count = 0
+
+# Returns (fast_fail_count, cutoff_count) summed over every process published since the
+# stats were cleared
+def get_stats(stats):
+    fast_fail_count = 0
+    cutoff_count = 0
+    for process_fast_fail_count, process_cutoff_count in stats.values():
+        fast_fail_count += process_fast_fail_count
+        cutoff_count += process_cutoff_count
+    return fast_fail_count, cutoff_count
+
+# Set in pool processes by install_host_health, None elsewhere
+worker_host_health = None
+
+def get_worker_host_health():
+    return worker_host_health
+
+# Pool initializer, hosts and stats are the shared dicts. The counts are published when
+# the worker exits, which only happens on Pool.close.
+def install_host_health(hosts, stats, max_timeout, min_timeout, failure_threshold):
+    global worker_host_health
+    worker_host_health = HostHealth(max_timeout, min_timeout, failure_threshold, hosts=hosts,
+                                    stats=stats)
+    util.Finalize(None, worker_host_health.publish, exitpriority=10)
@@ -0,0 +1,156 @@
+"""
+On-disk cache of downloaded html for the async scraping engine, so pages can be extracted
+again (different settings, a different extractor) without fetching them a second time.
+
+Responses are stored as received - the raw body bytes along with the charset from the
+Content-Type header (None without one) - so decoding happens again on replay exactly as
+it did the first time.
+
+Bodies are zstd compressed one frame each and appended to packed segment files
+("segment_*.bin", segment_size bytes each) rather than one file per url. A sqlite index
+maps the url to a hash of the charset and body, and that hash to (segment, offset,
+length, charset), so identical responses served under several urls are only stored once.
+
+With max_bytes set the oldest segments are deleted whole once the cache grows past it.
+Their index rows go with them, urls pointing at evicted content are simply misses.
+
+The sqlite connection can't be shared between threads, so a ResponseCache has to be
+created and used from a single thread. AsyncScraper keeps one thread for the cache so
+compression and sqlite I/O don't stall the event loop.
+"""
+
+import os
+import re
+import glob
+import sqlite3
+
+import zstandard
+
+from utils.url_index import hash_key
+
+import logging
+logger = logging.getLogger(__name__)
+
+class CacheMissError(Exception):
+    """Raised in replay mode for urls that aren't in the cache"""
+
+segment_regex = re.compile(r"segment_(\d+)\.bin$")
+
+class ResponseCache:
+    def __init__(self, cache_directory, max_bytes=None, segment_size=256 * 1024 * 1024,
+                 compression_level=3, commit_interval=1000):
+        os.makedirs(cache_directory, exist_ok=True)
+        self.cache_directory = cache_directory
+        self.max_bytes = max_bytes
+        self.segment_size = segment_size
+        self.commit_interval = commit_interval
+        self.uncommitted = 0
+        self.compressor = zstandard.ZstdCompressor(level=compression_level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+        self.connection = sqlite3.connect(os.path.join(cache_directory, "index.sqlite"))
+        self.cursor = self.connection.cursor()
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS content (key INTEGER PRIMARY KEY, "
+                            "segment INTEGER NOT NULL, offset INTEGER NOT NULL, "
+                            "length INTEGER NOT NULL, charset TEXT)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS content_segment ON content (segment)")
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS url (key INTEGER PRIMARY KEY, "
+                            "content INTEGER NOT NULL)")
+        self.connection.commit()
+
+        # Segment id -> size, oldest first
+        self.segments = {}
+        for segment_path in glob.glob(os.path.join(cache_directory, "segment_*.bin")):
+            segment_id = int(segment_regex.search(segment_path).group(1))
+            self.segments[segment_id] = os.path.getsize(segment_path)
+        self.segments = dict(sorted(self.segments.items()))
+        self.total_bytes = sum(self.segments.values())
+
+        self.segment_id = max(self.segments, default=0)
+        self.segments.setdefault(self.segment_id, 0)
+        self.segment_fh = open(self.get_segment_path(self.segment_id), "ab")
+        self.read_handles = {}
+
+    def get_segment_path(self, segment_id):
+        return os.path.join(self.cache_directory, f"segment_{segment_id:06d}.bin")
+
+    # Returns (body, charset), or None on a miss
+    def get(self, url):
+        self.cursor.execute("SELECT content.segment, content.offset, content.length, "
+                            "content.charset "
+                            "FROM url JOIN content ON url.content = content.key "
+                            "WHERE url.key = ?", (hash_key(url),))
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+
+        segment_id, offset, length, charset = row
+        if segment_id == self.segment_id:
+            self.segment_fh.flush()
+
+        fh = self.read_handles.get(segment_id)
+        if fh is None:
+            fh = self.read_handles[segment_id] = open(self.get_segment_path(segment_id), "rb")
+        fh.seek(offset)
+        return self.decompressor.decompress(fh.read(length)), charset
+
+    def put(self, url, body, charset):
+        content_key = hash_key((charset or "").encode("utf-8") + b"\0" + body)
+
+        self.cursor.execute("SELECT 1 FROM content WHERE key = ?", (content_key,))
+        if self.cursor.fetchone() is None:
+            if self.segments[self.segment_id] >= self.segment_size:
+                self.start_segment()
+
+            compressed = self.compressor.compress(body)
+            offset = self.segments[self.segment_id]
+            self.segment_fh.write(compressed)
+            self.segments[self.segment_id] += len(compressed)
+            self.total_bytes += len(compressed)
+            self.cursor.execute("INSERT INTO content VALUES (?, ?, ?, ?, ?)",
+                                (content_key, self.segment_id, offset, len(compressed), charset))
+
+        self.cursor.execute("INSERT OR REPLACE INTO url VALUES (?, ?)", (hash_key(url), content_key))
+
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_interval:
+            self.commit()
+
+        if self.max_bytes and self.total_bytes > self.max_bytes:
+            self.evict()
+
+    def start_segment(self):
+        self.segment_fh.close()
+        self.segment_id += 1
+        self.segments[self.segment_id] = 0
+        self.segment_fh = open(self.get_segment_path(self.segment_id), "ab")
+
+    # Deletes the oldest segments until the cache is back under max_bytes, never the one
+    # being written to
+    def evict(self):
+        for segment_id in list(self.segments):
+            if self.total_bytes <= self.max_bytes or segment_id == self.segment_id:
+                break
+
+            self.cursor.execute("DELETE FROM content WHERE segment = ?", (segment_id,))
+            self.commit()
+
+            fh = self.read_handles.pop(segment_id, None)
+            if fh:
+                fh.close()
+            os.remove(self.get_segment_path(segment_id))
+            self.total_bytes -= self.segments.pop(segment_id)
+            logger.info(f"Evicted cache segment {segment_id}")
+
+    # Segment data is flushed before the index rows pointing at it are committed
+    def commit(self):
+        self.segment_fh.flush()
+        self.connection.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.segment_fh.close()
+        for fh in self.read_handles.values():
+            fh.close()
+        self.connection.close()
@@ -1,15 +1,18 @@
 """
 This program iterates through URL files generated in step 2 above. For each file its hands out the URLs
-to a multiprocessing pool for scraping. Once all URLs in the batch are scraped, the successful results are 
-archived using a slightly modified version of [lm_dataformat](https://github.com/leogao2/lm_dataformat)
-(thanks @bmk). The following metadata fields are saved in the metadata dict offered by lm_dataformat:
+to a multiprocessing pool for scraping. Successful results are archived as they complete using a
+slightly modified version of [lm_dataformat](https://github.com/leogao2/lm_dataformat) (thanks @bmk).
+URLs matching the heuristics in filter.py are dropped when a batch is loaded and reported
+separately from scrape errors. Every checkpoint_interval URLs the archive is checkpointed and the
+finished URLs are recorded in a ".progress" file, so an interrupted batch resumes from its last
+checkpoint. The following metadata fields are saved in the metadata dict offered by lm_dataformat:
 
 title: Web Page Title  
 lang: Language detected by Newspaper scraper.  
 url: Original URL.  
 word_count: Total words outputted by Newspaper.  
 elapsed: Scraping time.  
-scraper: Always "newspaper".  
+scraper: "newspaper" or "fast", see --extractor.  
 domain: Top level domain for the original URL.  
 reddit_id: List of submission IDs containing URL - converted from base36.  
 subreddit: List of subreddits for the corresponding submissions.  
@@ -26,6 +29,52 @@ Arguments
     Number of worker processes in the pool. Defaults to 60. Don't go above this on Windows.
 --request_timeout (-timeout)
     Scraping timeout for each URL. Defaults to 30 seconds.
+--engine (-engine)
+    "pool" downloads and parses each URL in a multiprocessing pool. "async" fetches with
+    asyncio/aiohttp and parses in a separate process pool, see async_scraper.py.
+    Defaults to "pool".
+--extractor
+    "newspaper" extracts text with newspaper's parse. "fast" uses scrapers.fast_extract, a
+    single lxml parse with a paragraph density heuristic. See
+    benchmarks/extraction_benchmark.py for how they compare. Defaults to "newspaper".
+--max_connections (-conns)
+    Requests in flight at once with the async engine. Defaults to 1000.
+--parse_processes
+    Processes running newspaper's parse with the async engine. Defaults to the CPU count.
+--per_domain_limit
+    Requests in flight at once to a single host with the async engine, at least 1.
+    Defaults to 4.
+--checkpoint_interval
+    Scraped URLs between archive checkpoints. Defaults to 1000.
+--url_index
+    sqlite file of canonical URLs already scraped, see utils/url_index.py. Other spellings
+    of a page scraped by another batch (or run) are skipped. Defaults to None.
+--cache_directory
+    Keep downloaded html in a response cache in this directory and never fetch a cached
+    page again, see response_cache.py. Async engine only. Defaults to None.
+--cache_size_gb
+    Oldest cache segments are deleted once the cache grows past this. Defaults to None
+    (unbounded).
+--replay
+    Extract from the response cache only, without touching the network. Pages missing
+    from the cache count as errors. Requires --cache_directory.
+--min_timeout
+    Lower bound for the adaptive per-host timeouts, which are derived from each host's
+    recent latencies. Defaults to 5 seconds.
+--failure_threshold
+    Consecutive timeouts or connection errors after which no more requests are sent to a
+    host for a while (5 minutes). The pool engine's processes share this, see host_health.py. DNS failures and refused connections cut
+    a host off for an hour straight away. Defaults to 5.
+--dns_ttl
+    Seconds DNS answers are cached for. The pool engine's processes share one cache, see
+    dns_cache.py, the async engine uses aiohttp's resolver cache. 0 disables the cache.
+    Defaults to 300.
+--dns_negative_ttl
+    Seconds failed lookups are cached for by the pool engine. Defaults to 60.
+--max_response_mb
+    Responses bigger than this are abandoned (as soon as Content-Length says so, otherwise
+    once that much has arrived), as are responses whose Content-Type isn't html. 0 removes
+    the size cap. Defaults to 5.
 """
 
 import os
@@ -33,11 +82,20 @@ import sys
 import glob
 import json
 import argparse
+import multiprocessing
+from functools import partial
+from collections import Counter
 
 import tqdm
-from tqdm_multiprocess import TqdmMultiProcessPool
 
-from scraping.scrapers import newspaper_scraper
+from scraping.scrapers import newspaper_scraper, newspaper_parse, fast_scraper, fast_parse
+from scraping.scrapers import ResponseRejectedError, default_max_bytes, install_session
+from scraping.filter import filter_url_entries
+from scraping.dns_cache import DnsCache, install_dns_cache, get_stats
+from scraping.host_health import install_host_health
+from scraping.host_health import get_stats as get_host_health_stats
+from utils.url_index import UrlIndex
+from scraping.async_scraper import AsyncScraper, add_reddit_meta
 from utils.archiver import Reader, Archive
 from utils.utils import Timer
 
@@ -46,30 +104,134 @@ from utils.logger import setup_logger_tqdm
 logger = logging.getLogger(__name__)
 
 # Multiprocessed
-def download(url_entry, request_timeout, scraper,
-             memoize, tqdm_func, global_tqdm):
-
-    url, reddit_meta = url_entry    
-    text, meta, success = scraper(url, memoize, request_timeout=request_timeout)
+def download(url_entry, request_timeout, scraper, memoize, max_bytes):
+    url, reddit_meta = url_entry
+    text, meta, success = scraper(url, memoize, request_timeout=request_timeout,
+                                  max_bytes=max_bytes)
 
     if not success or text is None or text.strip() == "":
-        if global_tqdm:
-            global_tqdm.update()
-        return (text, meta, False)
+        return url, (text, meta, False)
 
     # Add extra meta
-    meta["reddit_id"] = reddit_meta["id"]
-    meta["subreddit"] = reddit_meta["subreddit"]
-    meta["reddit_score"] = reddit_meta["score"]
-    meta["reddit_title"] = reddit_meta["title"]
-    meta["reddit_created_utc"] = reddit_meta["created_utc"]
-
-    if global_tqdm:
-        global_tqdm.update()
-
-    return (text, meta, success)
-
-def scrape_urls(urls_directory, scrapes_directory, process_count, request_timeout):
+    add_reddit_meta(meta, reddit_meta)
+
+    return url, (text, meta, success)
+
+# Extractor name -> (scraper for the pool engine, parse for the async engine)
+extractors = {
+    "newspaper": (newspaper_scraper, newspaper_parse),
+    "fast": (fast_scraper, fast_parse),
+}
+
+# Pool initializer
+def init_pool_worker(dns_cache_args, host_health_args):
+    install_session()
+    if dns_cache_args:
+        install_dns_cache(*dns_cache_args)
+    if host_health_args:
+        install_host_health(*host_health_args)
+
+# dns_cache_args are the install_dns_cache arguments, None resolves without a cache.
+# host_health_args are the install_host_health arguments, None tracks no host health.
+def scrape_batch_pool(url_data, process_count, request_timeout, dns_cache_args=None,
+                      max_bytes=default_max_bytes, scraper=newspaper_scraper,
+                      host_health_args=None):
+    task = partial(download, request_timeout=request_timeout, scraper=scraper,
+                   memoize=False, max_bytes=max_bytes)
+    initializer_args = (dns_cache_args, host_health_args)
+    with multiprocessing.Pool(process_count, init_pool_worker, initializer_args) as pool:
+        yield from pool.imap_unordered(task, url_data)
+
+        # Let the workers exit by themselves so they publish their stats
+        pool.close()
+        pool.join()
+
+# Completed urls of a partially scraped batch, kept in "urls_*.jsonl.zst.progress". A line
+# is appended after each archive checkpoint with the archive size at that point and the
+# urls (successful or not) finished since the previous line. On restart the archive is
+# truncated back to the last recorded size and only the urls not listed are scraped.
+# Responses rejected before download are counted per reason (ResponseRejectedError.reason).
+class BatchProgress:
+    def __init__(self, progress_file_path):
+        self.progress_file_path = progress_file_path
+        self.completed = set()
+        self.error_count = 0
+        self.rejected = Counter()
+        self.archive_offset = None
+        self.pending_urls = []
+        self.pending_errors = 0
+        self.pending_rejected = Counter()
+
+        if not os.path.exists(progress_file_path):
+            return
+
+        # A line without its newline was cut off by a crash, drop it
+        with open(progress_file_path, "r+b") as fh:
+            valid_size = 0
+            for line in fh:
+                if not line.endswith(b"\n"):
+                    break
+                checkpoint = json.loads(line)
+                self.completed.update(checkpoint["urls"])
+                self.error_count += checkpoint["errors"]
+                self.rejected.update(checkpoint.get("rejected", {}))
+                self.archive_offset = checkpoint["archive_offset"]
+                valid_size += len(line)
+            fh.truncate(valid_size)
+
+    def add(self, url, success, meta):
+        self.pending_urls.append(url)
+        if not success:
+            self.pending_errors += 1
+            self.error_count += 1
+        if isinstance(meta, ResponseRejectedError):
+            self.pending_rejected[meta.reason] += 1
+            self.rejected[meta.reason] += 1
+
+    def checkpoint(self, archiver):
+        archive_offset = archiver.checkpoint()
+        checkpoint = {"archive_offset": archive_offset, "errors": self.pending_errors,
+                      "rejected": self.pending_rejected, "urls": self.pending_urls}
+        with open(self.progress_file_path, "a") as fh:
+            fh.write(json.dumps(checkpoint) + "\n")
+
+        self.completed.update(self.pending_urls)
+        self.archive_offset = archive_offset
+        self.pending_urls = []
+        self.pending_errors = 0
+        self.pending_rejected = Counter()
+
+def scrape_urls(urls_directory, scrapes_directory, process_count, request_timeout,
+                engine="pool", max_connections=1000, parse_processes=None, per_domain_limit=4,
+                checkpoint_interval=1000, url_index_path=None, cache_directory=None,
+                cache_max_bytes=None, replay=False, min_timeout=5, failure_threshold=5,
+                dns_ttl=300, dns_negative_ttl=60, max_bytes=default_max_bytes,
+                extractor="newspaper"):
+
+    scraper_function, parse_function = extractors[extractor]
+
+    url_index = None
+    if url_index_path:
+        url_index = UrlIndex(url_index_path, "scraped", "")
+
+    # Shared by the pool processes through a Manager
+    dns_cache = None
+    dns_cache_args = None
+    host_health_args = None
+    if engine == "pool":
+        manager = multiprocessing.Manager()
+        host_health_stats = manager.dict()
+        host_health_args = (manager.dict(), host_health_stats, request_timeout, min_timeout,
+                            failure_threshold)
+        if dns_ttl > 0:
+            dns_cache = DnsCache(manager.dict(), manager.dict(), dns_ttl, dns_negative_ttl)
+            dns_cache_args = (dns_cache.cache, dns_cache.stats, dns_ttl, dns_negative_ttl)
+
+    if engine == "async":
+        scraper = AsyncScraper(max_connections, parse_processes, request_timeout, per_domain_limit,
+                               cache_directory, cache_max_bytes, replay, min_timeout,
+                               failure_threshold, dns_ttl, max_bytes, parse_function)
+        host_health_stats = scraper.host_health.stats
 
     url_files = glob.glob(os.path.join(urls_directory, "urls_*.jsonl.zst"))
 
@@ -100,49 +262,101 @@ def scrape_urls(urls_directory, scrapes_directory, process_count, request_timeou
             logger.info(f"'{os.path.basename(url_file_path)}' already scraped, skipping.")
             continue
 
-        logger.info(f"Scraping URLs from '{os.path.basename(url_file_path)}'.")
-    
+        # urls_*.jsonl.zst -> scrapes_*.jsonl.zst
+        output_archive_name = os.path.basename(url_file_path).replace("urls", "scrapes")
+        output_archive_path = os.path.join(scrapes_directory, output_archive_name)
+
+        progress_file_path = url_file_path + ".progress"
+        if not os.path.exists(output_archive_path) and os.path.exists(progress_file_path):
+            os.remove(progress_file_path) # Archive is gone, so are the recorded scrapes
+        batch_progress = BatchProgress(progress_file_path)
+
         reader = Reader()
         url_data = []
+        batch_url_count = 0
         for url, reddit_meta in reader.read_jsonl(url_file_path, get_meta=True):
-            url_data.append((url, reddit_meta))
+            batch_url_count += 1
+            if url not in batch_progress.completed:
+                url_data.append((url, reddit_meta))
+
+        resumed_count = batch_url_count - len(url_data)
+        url_data, excluded_count = filter_url_entries(url_data)
+
+        # Drop other spellings of pages claimed by another batch or earlier in this one
+        duplicate_count = 0
+        if url_index:
+            url_index.set_source(os.path.abspath(url_file_path))
+            url_data = [url_entry for url_entry in url_data if url_index.claim(url_entry[0])]
+            url_index.commit()
+            duplicate_count = batch_url_count - resumed_count - excluded_count - len(url_data)
+
+        skipped_count = excluded_count + duplicate_count
+        progress.update(resumed_count + skipped_count)
+        if resumed_count:
+            logger.info(f"Resuming '{os.path.basename(url_file_path)}', "
+                        f"{resumed_count} URLs already scraped.")
+        else:
+            logger.info(f"Scraping URLs from '{os.path.basename(url_file_path)}'.")
 
         timer = Timer().start()
 
-        # Download and Process With Pool
-        pool = TqdmMultiProcessPool(process_count)
-        tasks = []
-        for url_entry in url_data:
-            arguments = (url_entry, request_timeout, newspaper_scraper, False)
-            task = (download, arguments)
-            tasks.append(task)
+        # Download and Process
+        if engine == "async":
+            results = scraper.scrape(url_data)
+        else:
+            results = scrape_batch_pool(url_data, process_count, request_timeout, dns_cache_args,
+                                        max_bytes, scraper_function, host_health_args)
+
+        # Results are archived as they arrive, with a checkpoint every checkpoint_interval
+        archiver = Archive(output_archive_path, resume_offset=batch_progress.archive_offset)
+        with tqdm.tqdm(total=batch_url_count, initial=resumed_count + skipped_count,
+                       dynamic_ncols=True) as batch_progress_bar:
+            batch_progress_bar.set_description(os.path.basename(url_file_path))
+            for url, (text, meta, status) in results:
+                if status:
+                    archiver.add_data(text, meta)
+                batch_progress.add(url, status, meta)
+                if len(batch_progress.pending_urls) >= checkpoint_interval:
+                    batch_progress.checkpoint(archiver)
+
+                batch_progress_bar.update()
+                progress.update()
+        archiver.commit()
 
-        # tqdm-multiprocess doesn't support multiple global tqdms, use on_done as well
-        on_done = lambda _ : progress.update()
-        on_error = lambda _ : None
+        excluded_percentage = excluded_count / max(batch_url_count, 1) * 100
+        logger.info(f"Excluded: {excluded_count} / {batch_url_count} ({excluded_percentage:0.2f}%)")
 
-        with tqdm.tqdm(total=len(url_data), dynamic_ncols=True) as batch_progress:
-            batch_progress.set_description(f"{os.path.basename(url_file_path)}")
-            results = pool.map(batch_progress, tasks, on_error, on_done)
+        if url_index:
+            logger.info(f"Duplicates: {duplicate_count} / {batch_url_count}")
 
-        logger.info("Archiving chunk with lm_dataformat...")
-        # urls_*.jsonl.zst -> scrapes_*.jsonl.zst
-        output_archive_name = os.path.basename(url_file_path).replace("urls", "scrapes")
-        output_archive_path = os.path.join(scrapes_directory, output_archive_name)
-        archiver = Archive(output_archive_path)
-        batch_error_count = 0        
-        for text, meta, status in results:
-            if not status:
-                batch_error_count += 1
-            else:
-                archiver.add_data(text, meta)
-        archiver.commit()
-
-        error_percentage = batch_error_count / len(url_data) * 100
-        logger.info(f"Errors: {batch_error_count} / {len(url_data)} ({error_percentage:0.2f}%)")
+        scraped_count = batch_url_count - skipped_count
+        batch_error_count = batch_progress.error_count
+        error_percentage = batch_error_count / max(scraped_count, 1) * 100
+        logger.info(f"Errors: {batch_error_count} / {scraped_count} ({error_percentage:0.2f}%)")
+        if batch_progress.rejected:
+            rejected = ", ".join(f"{reason} {count}" for reason, count
+                                 in batch_progress.rejected.most_common())
+            logger.info(f"Rejected before download (counted in errors): {rejected}")
         logger.info(f"Batch time: {timer.stop():0.2f} seconds")
 
-        json.dump(len(url_data), open(done_file_path, "w"))
+        fast_fail_count, cutoff_count = get_host_health_stats(host_health_stats)
+        logger.info(f"Unavailable hosts: {fast_fail_count} URLs failed fast, "
+                    f"{cutoff_count} hosts cut off")
+        host_health_stats.clear()
+
+        if dns_cache:
+            hits, misses = get_stats(dns_cache.stats)
+            hit_rate = hits / max(hits + misses, 1) * 100
+            logger.info(f"DNS cache: {hits} hits, {misses} misses ({hit_rate:0.2f}% hit rate)")
+            dns_cache.stats.clear()
+            dns_cache.purge()
+
+        json.dump(batch_url_count, open(done_file_path, "w"))
+        if os.path.exists(progress_file_path):
+            os.remove(progress_file_path)
+
+    if url_index:
+        url_index.close()
 
     progress.close()
     logger.info("Done!")
@@ -152,6 +366,21 @@ parser = argparse.ArgumentParser(description=parser_description)
 parser.add_argument("-dir", "--job_directory", default="")
 parser.add_argument("-procs", "--process_count", type=int, default=60)
 parser.add_argument("-timeout", "--request_timeout", type=int, default=30)
+parser.add_argument("-engine", "--engine", default="pool", choices=["pool", "async"])
+parser.add_argument("--extractor", default="newspaper", choices=list(extractors))
+parser.add_argument("-conns", "--max_connections", type=int, default=1000)
+parser.add_argument("--parse_processes", type=int, default=None)
+parser.add_argument("--per_domain_limit", type=int, default=4)
+parser.add_argument("--checkpoint_interval", type=int, default=1000)
+parser.add_argument("--url_index", default=None)
+parser.add_argument("--cache_directory", default=None)
+parser.add_argument("--cache_size_gb", type=float, default=None)
+parser.add_argument("--replay", action="store_true")
+parser.add_argument("--min_timeout", type=float, default=5)
+parser.add_argument("--failure_threshold", type=int, default=5)
+parser.add_argument("--dns_ttl", type=int, default=300)
+parser.add_argument("--dns_negative_ttl", type=int, default=60)
+parser.add_argument("--max_response_mb", type=float, default=5)
 
 if __name__ == "__main__":
     logfile_name = "scrape_urls.log"
@@ -164,9 +393,30 @@ if __name__ == "__main__":
         logger.info(f"No 'urls' directory found in '{args.job_directory}', aborting")
         sys.exit(0)
 
+    if args.replay and not args.cache_directory:
+        logger.info("--replay needs a --cache_directory to replay from, aborting")
+        sys.exit(0)
+
+    if args.per_domain_limit < 1:
+        logger.info("--per_domain_limit must be at least 1, aborting")
+        sys.exit(0)
+
+    if args.cache_directory and args.engine != "async":
+        logger.info("The response cache is only supported by the async engine, aborting")
+        sys.exit(0)
+
+    cache_max_bytes = None
+    if args.cache_size_gb:
+        cache_max_bytes = int(args.cache_size_gb * 1024 ** 3)
+
     scrapes_directory = os.path.join(args.job_directory, "scrapes")
     os.makedirs(scrapes_directory, exist_ok=True)
 
     logger.info(f"Scrapes outputting to: '{scrapes_directory}'") 
 
-    scrape_urls(urls_directory, scrapes_directory, args.process_count, args.request_timeout)    
+    scrape_urls(urls_directory, scrapes_directory, args.process_count, args.request_timeout,
+                args.engine, args.max_connections, args.parse_processes, args.per_domain_limit,
+                args.checkpoint_interval, args.url_index, args.cache_directory, cache_max_bytes,
+                args.replay, args.min_timeout, args.failure_threshold, args.dns_ttl,
+                args.dns_negative_ttl, int(args.max_response_mb * 1024 ** 2),
+                args.extractor)
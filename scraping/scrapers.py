@@ -1,14 +1,22 @@
 # Code taken in large part from https://github.com/jcpeterson/openwebtext
 
+import re
 import time
+import socket
 import unicodedata
+import http.cookiejar
 
 import bs4
+import requests
 import newspaper
 
+import lxml.html
+from lxml import etree
 from lxml.html.clean import Cleaner
 from htmlmin import minify
 from scraping.filter import should_exclude
+from scraping.domain_scheduler import get_domain
+from scraping.host_health import get_worker_host_health
 
 
 def find_and_filter_tag(tag, soup):
@@ -63,20 +71,137 @@ def raw_scraper(url, memoize):
     return html, metadata
 
 
-def newspaper_scraper(url, memoize, request_timeout):
-    t1 = time.time()
+# Responses are checked before their body is downloaded. Anything with a Content-Type
+# other than these is rejected, as is anything over max_bytes. Responses without a
+# Content-Type are let through for the parser to make sense of, like newspaper does.
+html_content_types = frozenset(["text/html", "application/xhtml+xml"])
 
-    if should_exclude(url):
-        # heuristic to make downloading faster
-        return None, {
-            "url": url,
-            "scraper": "newspaper",
-        }, False
+default_max_bytes = 5 * 1024 * 1024
+
+class ResponseRejectedError(Exception):
+    """Raised when a response is dropped by check_response_headers or the size cap"""
+
+    # Both passed on to Exception so it survives pickling back from the pool
+    def __init__(self, reason, detail):
+        super().__init__(reason, detail)
+        self.reason = reason
+
+    def __str__(self):
+        return f"{self.args[0]}: {self.args[1]}"
+
+# Shared by both engines, content_type and content_length as found in the headers
+def check_response_headers(content_type, content_length, max_bytes):
+    if content_type:
+        mime_type = content_type.split(";")[0].strip().lower()
+        if mime_type not in html_content_types:
+            raise ResponseRejectedError("content_type", mime_type)
+
+    if content_length and max_bytes:
+        try:
+            length = int(content_length)
+        except ValueError:
+            return
+        if length > max_bytes:
+            raise ResponseRejectedError("too_large", f"Content-Length {length}")
+
+# Decodes with the charset from the Content-Type header. Without one, or with one Python
+# doesn't know, the bytes are returned for newspaper/lxml to sniff the encoding from the
+# page, as newspaper's own download does. requests reports ISO-8859-1 for any text/*
+# response without a charset, so that counts as no charset too.
+def decode_body(body, charset):
+    if not charset or charset.lower() == "iso-8859-1":
+        return body
 
     try:
+        return body.decode(charset, errors="replace")
+    except LookupError: # Unknown charset in header
+        return body
+
+# Set in pool processes by install_session. Keep-alive connections are kept for up to
+# session_pool_hosts hosts, one each as a worker only has one request in flight. Cookies
+# are never stored, every request goes out like newspaper's own download.
+worker_session = None
+session_pool_hosts = 100
+
+# Pool initializer
+def install_session():
+    global worker_session
+    worker_session = requests.Session()
+    worker_session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    adapter = requests.adapters.HTTPAdapter(pool_connections=session_pool_hosts, pool_maxsize=1)
+    worker_session.mount("http://", adapter)
+    worker_session.mount("https://", adapter)
+
+# Same request as newspaper's download, streamed so it can be abandoned after the headers
+# or once max_bytes have arrived. Returns the body and the charset requests found for it.
+# Goes through the worker_session when there is one.
+def fetch_body(url, request_timeout, max_bytes):
+    headers = {"User-Agent": newspaper.Config().browser_user_agent}
+    get = worker_session.get if worker_session else requests.get
+    with get(url, headers=headers, timeout=request_timeout, stream=True) as response:
+        response.raise_for_status()
+        check_response_headers(response.headers.get("Content-Type"),
+                               response.headers.get("Content-Length"), max_bytes)
+
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(64 * 1024):
+            size += len(chunk)
+            if max_bytes and size > max_bytes:
+                raise ResponseRejectedError("too_large", f"over {max_bytes} bytes")
+            chunks.append(chunk)
+
+        return b"".join(chunks), response.encoding
+
+# requests wraps the socket errors a few levels down (ConnectionError, MaxRetryError,
+# NewConnectionError), find a DNS failure or refused connection in the chain
+def is_dead_host_error(ex):
+    while ex is not None:
+        if isinstance(ex, (socket.gaierror, ConnectionRefusedError)):
+            return True
+        ex = ex.__cause__ or ex.__context__
+    return False
+
+# Like newspaper, bodies without a usable charset are returned as bytes for the parser to
+# sniff. With a host_health (see host_health.py) requests to hosts that are cut off fail
+# straight away with HostUnavailableError, the others get the host's adaptive timeout
+# and their outcome is recorded the same way as in async_scraper.
+def fetch_html(url, request_timeout, max_bytes=default_max_bytes, host_health=None):
+    if host_health is None:
+        return decode_body(*fetch_body(url, request_timeout, max_bytes))
+
+    host = get_domain(url)
+    host_health.check(host)
+    timeout = host_health.get_timeout(host)
+    start = time.monotonic()
+
+    try:
+        body, charset = fetch_body(url, timeout, max_bytes)
+    except (requests.HTTPError, ResponseRejectedError): # The host itself is fine
+        host_health.record_success(host, time.monotonic() - start)
+        raise
+    except (requests.Timeout, requests.exceptions.ChunkedEncodingError) as ex:
+        host_health.record_failure(host, repr(ex))
+        raise
+    except requests.ConnectionError as ex:
+        if is_dead_host_error(ex):
+            host_health.record_dead(host, repr(ex))
+        else:
+            host_health.record_failure(host, repr(ex))
+        raise
+
+    host_health.record_success(host, time.monotonic() - start)
+    return decode_body(body, charset)
+
+# urls are expected to have been through filter.filter_url_entries already
+def newspaper_scraper(url, memoize, request_timeout, max_bytes=default_max_bytes):
+    t1 = time.time()
+
+    try:
+        html = fetch_html(url, request_timeout, max_bytes, get_worker_host_health())
         article = newspaper.Article(url, fetch_images=False, memoize_articles=memoize, 
                                     request_timeout=request_timeout)
-        article.download()
+        article.download(input_html=html)
         article.parse()
     except Exception as ex:
         return None, ex, False
@@ -105,6 +230,135 @@ def newspaper_scraper(url, memoize, request_timeout):
     }
     return text, metadata, True
 
+# newspaper_scraper without the download, for html already fetched by the async engine.
+# elapsed is filled in by the caller as it includes the download time.
+def newspaper_parse(url, html):
+    try:
+        article = newspaper.Article(url, fetch_images=False, memoize_articles=False)
+        article.download(input_html=html)
+        article.parse()
+    except Exception as ex:
+        return None, ex, False
+
+    text = article.text
+    count = len(text.split())
+
+    metadata = {
+        "title": article.title,
+        "lang": article.meta_lang,
+        "url": url,
+        "word_count": count,
+        "elapsed": None,
+        "scraper": "newspaper",
+    }
+    return text, metadata, True
+
+# Fast extractor: a single lxml parse and a paragraph density heuristic instead of
+# newspaper's parse. Paragraphs of at least fast_min_words words, with at most
+# fast_max_link_density of their words inside links, are scored by word count against
+# their parent element. The text is the paragraphs of the best scoring parent, plus those
+# in its children and in sibling containers scoring at least fast_sibling_ratio of it,
+# joined like newspaper's text.
+fast_drop_tags = ("script", "style", "noscript", "nav", "header", "footer", "aside", "form",
+                  "iframe", "svg", "button", "select", "template")
+fast_min_words = 4
+fast_max_link_density = 0.5
+fast_sibling_ratio = 0.25
+
+whitespace_regex = re.compile(r"\s+")
+lang_regex = re.compile(r"^[A-Za-z]{2}$")
+
+def get_meta_lang(doc):
+    lang = doc.get("lang")
+    if not lang:
+        for meta in doc.iterfind(".//meta[@http-equiv]"):
+            if meta.get("http-equiv").lower() == "content-language":
+                lang = meta.get("content")
+                break
+
+    if lang and lang_regex.match(lang[:2]):
+        return lang[:2].lower()
+    return None
+
+# Returns (title, lang, text) for a page
+def fast_extract(html):
+    if isinstance(html, str):
+        html = html.encode("utf-8")
+        parser = lxml.html.HTMLParser(encoding="utf-8")
+    else:
+        parser = None # lxml sniffs the charset from the page
+    doc = lxml.html.document_fromstring(html, parser=parser)
+
+    title_element = doc.find(".//title")
+    title = title_element.text_content().strip() if title_element is not None else ""
+    lang = get_meta_lang(doc)
+
+    etree.strip_elements(doc, *fast_drop_tags, with_tail=False)
+
+    parent_words = {}
+    paragraphs = []
+    for paragraph in doc.iter("p"):
+        text = whitespace_regex.sub(" ", paragraph.text_content()).strip()
+        word_count = len(text.split())
+        if word_count < fast_min_words:
+            continue
+
+        link_words = sum(len(link.text_content().split()) for link in paragraph.iter("a"))
+        if link_words / word_count > fast_max_link_density:
+            continue
+
+        parent = paragraph.getparent()
+        parent_words[parent] = parent_words.get(parent, 0) + word_count
+        paragraphs.append((parent, text))
+
+    if not paragraphs:
+        return title, lang, ""
+
+    best = max(parent_words, key=parent_words.get)
+    best_container = best.getparent()
+    min_sibling_words = parent_words[best] * fast_sibling_ratio
+
+    def keep(parent):
+        if parent is best or parent.getparent() is best:
+            return True
+        return parent.getparent() is best_container and parent_words[parent] >= min_sibling_words
+
+    text = "\n\n".join(text for parent, text in paragraphs if keep(parent))
+    return title, lang, text
+
+# newspaper_parse with the fast extractor
+def fast_parse(url, html):
+    try:
+        title, lang, text = fast_extract(html)
+    except Exception as ex:
+        return None, ex, False
+
+    count = len(text.split())
+
+    metadata = {
+        "title": title,
+        "lang": lang,
+        "url": url,
+        "word_count": count,
+        "elapsed": None,
+        "scraper": "fast",
+    }
+    return text, metadata, True
+
+# newspaper_scraper with the fast extractor
+def fast_scraper(url, memoize, request_timeout, max_bytes=default_max_bytes):
+    t1 = time.time()
+
+    try:
+        html = fetch_html(url, request_timeout, max_bytes, get_worker_host_health())
+    except Exception as ex:
+        return None, ex, False
+
+    text, metadata, success = fast_parse(url, html)
+    if success:
+        metadata["elapsed"] = time.time() - t1
+    return text, metadata, success
+
 def bs4_scraper(url, memoize):
     t1 = time.time()
     if should_exclude(url):
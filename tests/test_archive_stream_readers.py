@@ -0,0 +1,39 @@
+import os
+import random
+
+import zstandard as zstd
+
+from utils.archive_stream_readers import get_zstd_frames, ZstdFrameParallelReader
+
+def write_frames(file_path, data, frame_size):
+    with open(file_path, "wb") as fh:
+        for frame_index, start in enumerate(range(0, len(data), frame_size)):
+            # Every other frame leaves out the content size, so both estimates are used
+            cctx = zstd.ZstdCompressor(write_content_size=frame_index % 2 == 0)
+            fh.write(cctx.compress(data[start:start + frame_size]))
+
+def test_parallel_reader_fixed_size_reads(tmp_path):
+    rng = random.Random(0)
+    data = b"\n".join(f'{{"id": {i}, "value": "{rng.random()}"}}'.encode() for i in range(50000))
+    file_path = os.path.join(tmp_path, "frames.jsonl.zst")
+    write_frames(file_path, data, 100000)
+
+    frames = get_zstd_frames(file_path)
+    assert len(frames) > 1
+
+    read_size = 1000
+    chunks = []
+    with ZstdFrameParallelReader(file_path, frames, 4, max_pending_bytes=300000) as reader:
+        while True:
+            chunk = reader.read(read_size)
+            if not chunk:
+                break
+            assert len(chunk) <= read_size
+            chunks.append(chunk)
+            assert reader.pending_bytes <= 300000 or len(reader.pending) == 1
+
+        assert reader.tell() == os.path.getsize(file_path)
+
+    # Frames are a multiple of read_size, so only the last chunk is short
+    assert all(len(chunk) == read_size for chunk in chunks[:-1])
+    assert b"".join(chunks) == data
@@ -0,0 +1,22 @@
+import os
+
+from utils.url_index import UrlIndex
+
+def test_resumed_batch_keeps_duplicates_rejected(tmp_path):
+    index_path = os.path.join(tmp_path, "url_index.sqlite")
+    first = "https://www.example.com/story?utm_source=feed"
+    second = "http://example.com/story/"
+
+    url_index = UrlIndex(index_path, "scraped", "urls_0.jsonl.zst")
+    assert url_index.claim(first)
+    assert not url_index.claim(second)
+    url_index.close()
+
+    # Resumed batch, the first spelling was already scraped so only the second is claimed
+    url_index = UrlIndex(index_path, "scraped", "urls_0.jsonl.zst")
+    assert not url_index.claim(second)
+    assert url_index.claim(first)
+
+    url_index.set_source("urls_1.jsonl.zst")
+    assert not url_index.claim(first)
+    url_index.close()
@@ -1,6 +1,40 @@
 import lzma
 import zstandard as zstd
 import bz2
+import os
+import shutil
+import struct
+import subprocess
+from collections import deque
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+default_chunk_size = 16 * 1024 * 1024
+
+# Newer PushShift dumps are compressed with --long=31, the zstandard default only
+# allows windows up to 128MB.
+default_max_window_size = 2 ** 31
+
+# Frames larger than this (compressed) are streamed rather than decompressed whole
+# in memory by ZstdFrameParallelReader.
+max_parallel_frame_size = 64 * 1024 * 1024
+
+# Decompressed bytes ZstdFrameParallelReader keeps queued ahead of the reader. Sizes come
+# from the frame headers, frames without one are assumed to expand by
+# assumed_compression_ratio until some frames have been decompressed.
+default_max_pending_bytes = 1024 * 1024 * 1024
+assumed_compression_ratio = 8
+
+# Parallel command line decompressors tried in order before falling back to the stdlib.
+# Each reads the compressed file from stdin and writes to stdout.
+external_decompressors = {
+    "bz2": [["lbzip2", "-dc"], ["pbzip2", "-dc"]],
+    "xz": [["xz", "-dc", "-T0"]],
+}
+
+zstd_magic = 0xFD2FB528
+zstd_skippable_magic_mask = 0xFFFFFFF0
+zstd_skippable_magic = 0x184D2A50
 
 # Lets you access the underyling file's tell function for updating pqdm
 class ArchiveStreamReader(object):
@@ -25,12 +59,230 @@ class ArchiveStreamReader(object):
     def read(self, size):
         return self.stream_reader.read(size)
 
-def get_archive_stream_reader(file_path):
+class ExternalDecompressor(object):
+    """
+    Stream reader piping through a command line decompressor. The child process gets our
+    file handle as stdin, sharing the file offset, so ArchiveStreamReader.tell() still
+    reports how far through the compressed file we are.
+    """
+
+    def __init__(self, command, file_handle):
+        self.command = command
+        self.process = subprocess.Popen(command, stdin=file_handle, stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE, bufsize=default_chunk_size)
+
+    def read(self, size):
+        data = self.process.stdout.read(size)
+        if not data:
+            error = self.process.stderr.read()
+            if self.process.wait() != 0:
+                raise IOError(f"{self.command[0]} failed: {error.decode('utf-8', 'replace').strip()}")
+        return data
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.stdout.close()
+        self.process.stderr.close()
+        self.process.wait()
+
+def find_external_decompressor(extension):
+    for command in external_decompressors.get(extension, []):
+        if shutil.which(command[0]):
+            return command
+    return None
+
+def get_zstd_frames(file_path, max_frame_size=None):
+    """
+    Returns [(offset, size, content_size), ...] for each zstd frame in the file by walking
+    the frame and block headers, without decompressing anything. content_size is the
+    decompressed size from the frame header, None if the header doesn't record it.
+    Skippable frames are left out. If
+    'max_frame_size' is given we stop early and return None once a frame exceeds it.
+    """
+    frames = []
+    file_size = os.path.getsize(file_path)
+    with open(file_path, "rb") as fh:
+        offset = 0
+        while offset < file_size:
+            fh.seek(offset)
+            header = fh.read(18) # Maximum frame header size
+            magic, = struct.unpack("<I", header[:4])
+
+            if magic & zstd_skippable_magic_mask == zstd_skippable_magic:
+                skippable_size, = struct.unpack("<I", header[4:8])
+                offset += 8 + skippable_size
+                continue
+
+            if magic != zstd_magic:
+                raise ValueError(f"Invalid zstd frame at offset {offset} in '{file_path}'")
+
+            frame_parameters = zstd.get_frame_parameters(header)
+            position = offset + zstd.frame_header_size(header)
+            while True:
+                fh.seek(position)
+                block_header = int.from_bytes(fh.read(3), "little")
+                last_block = block_header & 1
+                block_type = (block_header >> 1) & 3
+                block_size = block_header >> 3
+                position += 3 + (1 if block_type == 1 else block_size) # RLE blocks store 1 byte
+                if last_block:
+                    break
+                if max_frame_size and position - offset > max_frame_size:
+                    return None
+
+            if frame_parameters.has_checksum:
+                position += 4
+
+            content_size = frame_parameters.content_size
+            if content_size == zstd.CONTENTSIZE_UNKNOWN:
+                content_size = None
+
+            frames.append((offset, position - offset, content_size))
+            offset = position
+
+    return frames
+
+class ZstdFrameParallelReader(object):
+    """
+    Drop in replacement for ArchiveStreamReader on zstd files containing multiple frames.
+    Frames are independent so we decompress up to 'threads' of them at once in a thread
+    pool (zstandard releases the GIL), handing the output back in the original order.
+    Frames are queued ahead while their decompressed size stays under max_pending_bytes.
+    tell() returns the end of the last frame handed back, for progress bars.
+    """
+
+    def __init__(self, file_path, frames, threads, max_window_size=default_max_window_size,
+                 max_pending_bytes=default_max_pending_bytes):
+        self.file_path = file_path
+        self.frames = frames
+        self.threads = threads
+        self.max_window_size = max_window_size
+        self.max_pending_bytes = max_pending_bytes
+        self.executor = None
+        self.pending = None
+        self.pending_bytes = 0
+        self.compressed_bytes = 0 # Of the frames decompressed so far, for the ratio
+        self.decompressed_bytes = 0
+        self.next_frame = 0
+        self.position = 0
+        self.buffer = b""
+        self.buffer_position = 0
+
+    def __enter__(self):
+        self.executor = ThreadPoolExecutor(self.threads)
+        self.pending = deque()
+        self.fill_pending()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for future, _, _, _ in self.pending:
+            future.cancel()
+        self.executor.shutdown(wait=True)
+
+    def decompress_frame(self, offset, size):
+        with open(self.file_path, "rb") as fh:
+            fh.seek(offset)
+            data = fh.read(size)
+        dctx = zstd.ZstdDecompressor(max_window_size=self.max_window_size)
+        return dctx.decompressobj().decompress(data)
+
+    def estimate_size(self, size, content_size):
+        if content_size is not None:
+            return content_size
+        if self.compressed_bytes:
+            return size * self.decompressed_bytes // self.compressed_bytes
+        return size * assumed_compression_ratio
+
+    # Keep up to two frames per thread queued so the pool never runs dry, as long as they
+    # fit in max_pending_bytes. There is always at least one frame queued.
+    def fill_pending(self):
+        while self.next_frame < len(self.frames) and len(self.pending) < self.threads * 2:
+            offset, size, content_size = self.frames[self.next_frame]
+            estimate = self.estimate_size(size, content_size)
+            if self.pending and self.pending_bytes + estimate > self.max_pending_bytes:
+                break
+
+            future = self.executor.submit(self.decompress_frame, offset, size)
+            self.pending.append((future, offset, size, estimate))
+            self.pending_bytes += estimate
+            self.next_frame += 1
+
+    def tell(self):
+        return self.position
+
+    def read(self, size):
+        while self.buffer_position >= len(self.buffer):
+            if not self.pending:
+                return b""
+
+            future, offset, frame_size, estimate = self.pending.popleft()
+            self.buffer = future.result()
+            self.buffer_position = 0
+            self.compressed_bytes += frame_size
+            self.decompressed_bytes += len(self.buffer)
+            self.pending_bytes -= estimate
+            self.position = offset + frame_size
+            self.fill_pending()
+
+        chunk = self.buffer[self.buffer_position:self.buffer_position + size]
+        self.buffer_position += len(chunk)
+        return chunk
+
+def get_zstd_stream_reader(file_path, max_window_size=default_max_window_size, threads=0):
+    if threads > 1:
+        frames = get_zstd_frames(file_path, max_parallel_frame_size)
+        if frames and len(frames) > 1:
+            return ZstdFrameParallelReader(file_path, frames, threads, max_window_size)
+
+    dctx = zstd.ZstdDecompressor(max_window_size=max_window_size)
+    return ArchiveStreamReader(file_path, partial(dctx.stream_reader, read_across_frames=True))
+
+def get_archive_stream_reader(file_path, max_window_size=default_max_window_size, threads=0,
+                              use_external_tools=True):
     extension = file_path.split(".")[-1]
 
     if extension == "zst":
-        return ArchiveStreamReader(file_path, zstd.ZstdDecompressor().stream_reader)
-    elif extension == "bz2":
+        return get_zstd_stream_reader(file_path, max_window_size, threads)
+
+    if use_external_tools:
+        command = find_external_decompressor(extension)
+        if command:
+            return ArchiveStreamReader(file_path, partial(ExternalDecompressor, command))
+
+    if extension == "bz2":
         return ArchiveStreamReader(file_path, bz2.BZ2File)
     elif extension == "xz":
-        return ArchiveStreamReader(file_path, lzma.open)
\ No newline at end of file
+        return ArchiveStreamReader(file_path, lzma.open)
+
+def iterate_lines(reader, chunk_size=default_chunk_size):
+    """
+    Yields complete lines as bytes (without the newline) from anything with a read(size)
+    method. Lines spanning chunk boundaries are stitched together, so there is no limit on
+    line length and nothing is decoded here - a bad UTF-8 sequence only affects its own
+    line when the caller decodes it. A final line without a trailing newline is still yielded.
+    """
+    pieces = [] # Partial line carried over from previous chunks
+    while True:
+        chunk = reader.read(chunk_size)
+        if not chunk:
+            break
+
+        lines = chunk.split(b"\n")
+        if len(lines) == 1:
+            pieces.append(chunk)
+            continue
+
+        if pieces:
+            pieces.append(lines[0])
+            lines[0] = b"".join(pieces)
+            pieces = []
+
+        last = lines.pop()
+        if last:
+            pieces.append(last)
+
+        yield from lines
+
+    if pieces:
+        yield b"".join(pieces)
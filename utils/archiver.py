@@ -1,60 +1,90 @@
 import os
 import zstandard
-import json
-import jsonlines
-import io
-import datetime
 
-def json_serial(obj):
-    """JSON serializer for objects not serializable by default json code"""
-
-    if isinstance(obj, (datetime.datetime,)):
-        return obj.isoformat()
-    raise TypeError ("Type %s not serializable" % type(obj))
+from utils.json_codec import json_serial, loads, dumps # json_serial used to live here
+from utils.archive_stream_readers import iterate_lines, get_zstd_stream_reader
 
 # Modified version of lm_dataformat Archive for single file.
+# If frame_size is set a new zstd frame is started after roughly that many uncompressed
+# bytes, allowing Reader(threads=N) to decompress the file in parallel.
+# With resume_offset set an existing file is truncated to that size (normally a value
+# returned by checkpoint) and appended to, rather than overwritten.
 class Archive:
-    def __init__(self, file_path, compression_level=3):
+    def __init__(self, file_path, compression_level=3, frame_size=None, resume_offset=None):
         self.file_path = file_path
+        self.frame_size = frame_size
+        self.frame_bytes = 0
         dir_name = os.path.dirname(file_path)
         if dir_name:
             os.makedirs(dir_name, exist_ok=True)    
-        self.fh = open(self.file_path, 'wb')
+        if resume_offset is None:
+            self.fh = open(self.file_path, 'wb')
+        else:
+            self.fh = open(self.file_path, 'r+b')
+            self.fh.truncate(resume_offset)
+            self.fh.seek(resume_offset)
         self.cctx = zstandard.ZstdCompressor(level=compression_level)
         self.compressor = self.cctx.stream_writer(self.fh)        
     
     def add_data(self, data, meta={}):
-        self.compressor.write(json.dumps({'text': data, 'meta': meta}, default=json_serial).encode('UTF-8') + b'\n')
+        self.add_raw(dumps({'text': data, 'meta': meta}))
+
+    # Record already serialized, for example a line from Reader.read_jsonl_raw
+    def add_raw(self, record):
+        self.compressor.write(record + b'\n')
+
+        if self.frame_size:
+            self.frame_bytes += len(record) + 1
+            if self.frame_bytes >= self.frame_size:
+                self.compressor.flush(zstandard.FLUSH_FRAME)
+                self.frame_bytes = 0
     
+    # Ends the current frame and returns the file size. Everything before that offset can be
+    # read back even if the process dies before commit.
+    def checkpoint(self):
+        self.compressor.flush(zstandard.FLUSH_FRAME)
+        self.frame_bytes = 0
+        self.fh.flush()
+        return self.fh.tell()
+
     def commit(self):
         self.compressor.flush(zstandard.FLUSH_FRAME)        
         self.fh.flush()
         self.fh.close()
 
 # Modified version of lm_dataformat Reader with self.fh set, allowing peeking for tqdm.
+# With threads > 1 files written with multiple frames are decompressed in parallel.
 class Reader:
-    def __init__(self):
-        pass
+    def __init__(self, threads=0):
+        self.threads = threads
+
+    def read_jsonl_lines(self, file):
+        with get_zstd_stream_reader(file, threads=self.threads) as reader:
+            self.fh = reader # Only tell() is used
+            for line in iterate_lines(reader):
+                if line:
+                    yield line
+
+    # Yields (raw line, parsed record), the raw line can be passed straight to Archive.add_raw
+    def read_jsonl_raw(self, file):
+        for line in self.read_jsonl_lines(file):
+            yield line, loads(line)
 
     def read_jsonl(self, file, get_meta=False, autojoin_paragraphs=True, para_joiner='\n\n'):
-        with open(file, 'rb') as fh:
-            self.fh = fh
-            cctx = zstandard.ZstdDecompressor()
-            reader = io.BufferedReader(cctx.stream_reader(fh))
-            rdr = jsonlines.Reader(reader)
-            for ob in rdr:
-                # naive jsonl where each object is just the string itself, with no meta. For legacy compatibility.
-                if isinstance(ob, str):
-                    assert not get_meta
-                    yield ob
-                    continue
-
-                text = ob['text']
-
-                if autojoin_paragraphs and isinstance(text, list):
-                    text = para_joiner.join(text)
-
-                if get_meta:
-                    yield text, (ob['meta'] if 'meta' in ob else {})
-                else:
-                    yield text
\ No newline at end of file
+        for line in self.read_jsonl_lines(file):
+            ob = loads(line)
+            # naive jsonl where each object is just the string itself, with no meta. For legacy compatibility.
+            if isinstance(ob, str):
+                assert not get_meta
+                yield ob
+                continue
+
+            text = ob['text']
+
+            if autojoin_paragraphs and isinstance(text, list):
+                text = para_joiner.join(text)
+
+            if get_meta:
+                yield text, (ob['meta'] if 'meta' in ob else {})
+            else:
+                yield text
\ No newline at end of file
@@ -0,0 +1,95 @@
+"""
+JSON encoding/decoding used for the PushShift dumps and our jsonl.zst archives.
+
+Parsing uses the fastest backend installed - orjson, then simdjson (pysimdjson), falling
+back to the stdlib json module. Neither is in requirements.txt, install one if you want the
+speedup. The fast parsers are stricter than the stdlib (no NaN, 64 bit integer limit), so
+anything they reject is retried with the stdlib to guarantee the same results either way.
+
+loads_projection returns a dict of only the requested top level keys (those present).
+
+Writing always uses the stdlib, orjson has no way of matching the ", " separators and
+ASCII escaping of json.dumps and we want output byte identical to older archives. We still
+save a fair bit by reusing a single encoder - json.dumps builds a new JSONEncoder on every
+call when passed 'default'.
+"""
+
+import json
+import datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+def json_serial(obj):
+    """JSON serializer for objects not serializable by default json code"""
+
+    if isinstance(obj, (datetime.datetime,)):
+        return obj.isoformat()
+    raise TypeError ("Type %s not serializable" % type(obj))
+
+def stdlib_loads(data):
+    if isinstance(data, (bytes, bytearray)):
+        data = data.decode("utf-8")
+    return json.loads(data)
+
+if orjson:
+    backend = "orjson"
+    def loads(data):
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            return stdlib_loads(data)
+elif simdjson:
+    backend = "simdjson"
+    def loads(data):
+        try:
+            return simdjson.loads(data)
+        except (ValueError, RuntimeError):
+            return stdlib_loads(data)
+else:
+    backend = "json"
+    loads = stdlib_loads
+
+# Projection - only the requested top level keys are returned. simdjson parses lazily so
+# nested objects we don't ask for are never turned into python objects, otherwise we do
+# a full parse with the loads above and pick the keys out.
+if simdjson:
+    projection_backend = "simdjson"
+    simdjson_parser = simdjson.Parser()
+
+    def loads_projection(data, keys):
+        try:
+            document = simdjson_parser.parse(data)
+            projection = {}
+            for key in keys:
+                if key not in document:
+                    continue
+                value = document[key]
+                if isinstance(value, simdjson.Object):
+                    value = value.as_dict()
+                elif isinstance(value, simdjson.Array):
+                    value = value.as_list()
+                projection[key] = value
+            return projection
+        except (ValueError, RuntimeError):
+            document = stdlib_loads(data)
+            return {key: document[key] for key in keys if key in document}
+else:
+    projection_backend = backend
+
+    def loads_projection(data, keys):
+        document = loads(data)
+        return {key: document[key] for key in keys if key in document}
+
+encoder = json.JSONEncoder(default=json_serial)
+
+def dumps(obj):
+    """Same output as json.dumps(obj, default=json_serial), encoded to bytes."""
+    return encoder.encode(obj).encode("utf-8")
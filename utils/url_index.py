@@ -0,0 +1,125 @@
+"""
+URL canonicalization and a persistent index of claimed URLs, used to make sure each page
+is fetched once across generate_urls runs (different periods) and scrape_urls batches.
+
+canonicalize_url maps the usual spellings of a page onto one key: the scheme, "www.",
+default ports, fragments, tracking parameters (utm_*, fbclid etc.) and trailing slashes
+are dropped, the host is lowercased and the remaining query parameters are sorted.
+
+UrlIndex stores a 64 bit hash of the canonical url in a sqlite table (a rowid table, so
+the B-tree holds nothing but the keys and three integers). Each claim records the source
+(url directory or url file), the session that made it and a hash of the url as spelled
+in the claim. A url is granted when it is new, or when the same spelling was claimed by
+the same source in an earlier session - an interrupted run of the same period or batch
+gets its own urls back rather than losing them, while the other spellings it rejected as
+duplicates stay rejected even if the granted one isn't claimed again.
+
+Several tables can live in one index file, generate_urls and scrape_urls use their own.
+"""
+
+import os
+import time
+import sqlite3
+import hashlib
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+tracking_params = frozenset([
+    'fbclid',
+    'gclid',
+    'dclid',
+    'msclkid',
+    'mc_cid',
+    'mc_eid',
+    'igshid',
+    'yclid',
+    '_ga',
+])
+
+default_ports = {'http': 80, 'https': 443}
+
+def is_tracking_param(name):
+    name = name.lower()
+    return name.startswith('utm_') or name in tracking_params
+
+def canonicalize_url(url):
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+        port = parts.port
+    except ValueError:
+        return url
+
+    host = parts.hostname
+    if not host:
+        return url
+
+    if host.startswith('www.'):
+        host = host[4:]
+
+    if port and port != default_ports.get(parts.scheme.lower()):
+        host = f"{host}:{port}"
+
+    path = parts.path.rstrip('/')
+
+    query = [(name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+             if not is_tracking_param(name)]
+    if query:
+        query.sort()
+        return f"{host}{path}?{urlencode(query)}"
+
+    return f"{host}{path}"
+
+def hash_key(string):
+    if isinstance(string, str):
+        string = string.encode('utf-8')
+    digest = hashlib.blake2b(string, digest_size=8).digest()
+    return int.from_bytes(digest, 'little', signed=True)
+
+class UrlIndex:
+    def __init__(self, index_path, table, source):
+        dir_name = os.path.dirname(index_path)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+
+        self.table = table
+        self.source = hash_key(source)
+        self.session = time.time_ns()
+        self.duplicate_count = 0
+
+        self.connection = sqlite3.connect(index_path)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute(f"CREATE TABLE IF NOT EXISTS {table} "
+                            "(key INTEGER PRIMARY KEY, source INTEGER NOT NULL, "
+                            "session INTEGER NOT NULL, spelling INTEGER NOT NULL)")
+        self.connection.commit()
+
+    def set_source(self, source):
+        self.source = hash_key(source)
+
+    # Returns True if the url is ours to fetch, False if it was claimed elsewhere, earlier in
+    # this session or as another spelling in an earlier session
+    def claim(self, url):
+        key = hash_key(canonicalize_url(url))
+        spelling = hash_key(url.strip())
+        self.cursor.execute(f"INSERT OR IGNORE INTO {self.table} VALUES (?, ?, ?, ?)",
+                            (key, self.source, self.session, spelling))
+        if self.cursor.rowcount == 1:
+            return True
+
+        self.cursor.execute(f"SELECT source, session, spelling FROM {self.table} WHERE key = ?",
+                            (key,))
+        source, session, claimed_spelling = self.cursor.fetchone()
+        if source == self.source and session != self.session and spelling == claimed_spelling:
+            self.cursor.execute(f"UPDATE {self.table} SET session = ? WHERE key = ?",
+                                (self.session, key))
+            return True
+
+        self.duplicate_count += 1
+        return False
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()